@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import bisect
+import hashlib
+import logging
+import socket
+import threading
+
+from firehooks import decoder
+
+
+LOGGER = logging.getLogger('firehooks')
+
+# payload fields identifying the change an event is about
+CHANGE_FIELDS = ('change.id', 'change.number')
+
+
+def change_key(msg):
+    """Returns: the id of the change msg is about, None if unknown"""
+    try:
+        change = decoder.decode(msg, CHANGE_FIELDS).get('change', {})
+        key = change.get('id') or change.get('number')
+    except Exception:
+        return None
+    if key is None:
+        return None
+    return str(key)
+
+
+class HashRing(object):
+    """A consistent hash ring mapping keys to cluster members."""
+
+    def __init__(self, members=(), replicas=64):
+        self.replicas = replicas
+        self._keys = []
+        self._ring = {}
+        self.members = set()
+        for member in members:
+            self.add(member)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+
+    def add(self, member):
+        if member in self.members:
+            return
+        self.members.add(member)
+        for i in range(self.replicas):
+            h = self._hash('%s#%s' % (member, i))
+            self._ring[h] = member
+            bisect.insort(self._keys, h)
+
+    def remove(self, member):
+        if member not in self.members:
+            return
+        self.members.discard(member)
+        for i in range(self.replicas):
+            h = self._hash('%s#%s' % (member, i))
+            del self._ring[h]
+            self._keys.remove(h)
+
+    def get(self, key):
+        if not self._keys:
+            return None
+        idx = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[self._keys[idx]]
+
+
+class Cluster(object):
+    """Leader-free partitioning of the firehose between firehooks instances.
+
+    Two modes are supported:
+
+    * "shared": the broker load-balances events between the instances of
+      the group through an MQTT shared subscription. The events of a
+      change are then spread across instances: they are no longer handled
+      in order, and the change store of each instance only sees part of
+      them.
+    * "hash": every instance consumes the whole firehose and only handles
+      the events whose change hashes to it on a consistent hash ring.
+      Members announce themselves with a retained message on
+      firehooks/cluster/<group>/<name>, cleared by their last will, so the
+      ring is rebalanced whenever an instance joins or leaves."""
+
+    # payload fields used to partition events
+    payload_fields = CHANGE_FIELDS
+
+    def __init__(self, name=None, group='firehooks', mode='hash',
+                 replicas=64):
+        if mode not in ('hash', 'shared'):
+            raise ValueError('Unknown cluster mode "%s"' % mode)
+        self.name = name or socket.gethostname()
+        self.group = group
+        self.mode = mode
+        self.prefix = 'firehooks/cluster/%s/' % group
+        self.ring = HashRing([self.name], replicas=replicas)
+        self._lock = threading.Lock()
+
+    @property
+    def member_topic(self):
+        return self.prefix + self.name
+
+    @property
+    def subscription(self):
+        if self.mode == 'shared':
+            return '$share/%s/#' % self.group
+        return '#'
+
+    def setup(self, client):
+        """Must be called before connecting to the broker."""
+        if self.mode == 'hash':
+            client.will_set(self.member_topic, payload=None, qos=1,
+                            retain=True)
+
+    def on_connect(self, client):
+        if self.mode == 'hash':
+            client.subscribe(self.prefix + '+', qos=1)
+            client.publish(self.member_topic, payload='online', qos=1,
+                           retain=True)
+
+    def leave(self, client):
+        """Clear our membership explicitly, rather than waiting for the
+        broker to notice the connection is gone."""
+        if self.mode == 'hash':
+            client.publish(self.member_topic, payload=None, qos=1,
+                           retain=True)
+            client.loop(timeout=1.0)
+
+    def handle_membership(self, msg):
+        """Update the ring from a membership message.
+
+        Returns: True if the message was a membership message"""
+        if not msg.topic.startswith(self.prefix):
+            return False
+        member = msg.topic[len(self.prefix):]
+        if not member or member == self.name:
+            return True
+        with self._lock:
+            if msg.payload:
+                if member not in self.ring.members:
+                    LOGGER.info('Cluster: member "%s" joined' % member)
+                self.ring.add(member)
+            else:
+                if member in self.ring.members:
+                    LOGGER.info('Cluster: member "%s" left' % member)
+                self.ring.remove(member)
+        return True
+
+    @classmethod
+    def partition_key(cls, msg):
+        """In "hash" mode, events are partitioned by change, so that all the
+        events of a given change are handled in order by the same
+        instance."""
+        key = change_key(msg)
+        if key is None:
+            return msg.topic
+        return key
+
+    def owns(self, msg):
+        if self.mode == 'shared':
+            return True
+        with self._lock:
+            return self.ring.get(self.partition_key(msg)) == self.name
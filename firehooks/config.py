@@ -16,10 +16,112 @@
 # under the License.
 
 
+import six
 import yaml
 
+from firehooks.dispatcher import PRIORITIES
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+class ConfigError(Exception):
+    """Triggered when the configuration file is invalid."""
+
+
+NUMBER = six.integer_types + (float, )
+
+# section: (type, {required key: type}, {optional key: type}). Unknown keys
+# are rejected, unless optional keys are None.
+SCHEMA = {
+    'logging': (dict, {}, {'level': six.string_types}),
+    'broker': (dict, {'url': six.string_types, 'port': int}, None),
+    'software-factory': (dict, {'auth': dict,
+                                'url': six.string_types,
+                                'managesf': six.string_types,
+                                'gerrit': six.string_types},
+                         {'verify': (bool, ) + six.string_types,
+                          'reviews': dict,
+                          'cache': dict}),
+    'hooks': (dict, {}, None),
+    'cluster': (dict, {}, {'name': six.string_types,
+                           'group': six.string_types,
+                           'mode': six.string_types,
+                           'replicas': int}),
+    'scheduling': (dict, {}, {'workers': int,
+                              'min_workers': int,
+                              'max_workers': int,
+                              'target_lag': NUMBER,
+                              'scale_interval': NUMBER,
+                              'drain_timeout': NUMBER,
+                              'events': dict}),
+    'profiling': (dict, {'directory': six.string_types},
+                  {'threshold': NUMBER,
+                   'hooks': list,
+                   'sample_rate': NUMBER}),
+    'decoder': (six.string_types, {}, None),
+    'state': (dict, {}, {'path': six.string_types,
+                         'max_changes': int,
+                         'flush_interval': NUMBER}),
+    'monitoring': (dict, {}, {'topic': six.string_types}),
+}
+REQUIRED = ('broker', 'software-factory')
+# (section, key): allowed values
+CHOICES = {
+    ('logging', 'level'): ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+    ('cluster', 'mode'): ('hash', 'shared'),
+}
+
+
+def validate(config):
+    if not isinstance(config, dict):
+        raise ConfigError('The configuration must be a mapping')
+    for section in REQUIRED:
+        if section not in config:
+            raise ConfigError('Missing section "%s"' % section)
+    for section, (_type, keys, optional) in SCHEMA.items():
+        if section not in config:
+            continue
+        value = config[section]
+        if not isinstance(value, _type):
+            raise ConfigError('Section "%s" has an invalid type' % section)
+        for key, key_type in keys.items():
+            if not isinstance(value.get(key), key_type):
+                raise ConfigError('Invalid or missing "%s" in section "%s"'
+                                  % (key, section))
+        if optional is None:
+            continue
+        for key in value:
+            key_type = keys.get(key) or optional.get(key)
+            if key_type is None:
+                raise ConfigError('Unknown "%s" in section "%s"'
+                                  % (key, section))
+            if not isinstance(value[key], key_type):
+                raise ConfigError('Invalid "%s" in section "%s"'
+                                  % (key, section))
+            choices = CHOICES.get((section, key))
+            if choices and value[key] not in choices:
+                raise ConfigError('Invalid "%s" in section "%s", expected '
+                                  'one of %s' % (key, section,
+                                                 ', '.join(choices)))
+    events = config.get('scheduling', {}).get('events', {})
+    for event, priority in events.items():
+        if priority not in PRIORITIES:
+            raise ConfigError('Invalid priority "%s" for event "%s", '
+                              'expected one of %s' % (
+                                  priority, event, ', '.join(PRIORITIES)))
+    for hook_name, hooks in config.get('hooks', {}).items():
+        if not isinstance(hooks, list) or\
+                not all(isinstance(h, dict) for h in hooks):
+            raise ConfigError(
+                'Hook "%s" must be configured as a list of mappings'
+                % hook_name)
+
 
 class Config(object):
     def __init__(self, config_path):
-        with open(config_path) as _config:
-            self.config = yaml.load(_config)
+        with open(config_path, 'rb') as _config:
+            self.config = yaml.load(_config, Loader=SafeLoader)
+        validate(self.config)
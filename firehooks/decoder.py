@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import importlib
+import time
+
+
+# JSON libraries, fastest first. They all provide a loads() function
+# accepting bytes.
+BACKENDS = ('orjson', 'ujson', 'simplejson', 'json')
+
+backend = None
+loads = None
+
+
+def set_backend(name=None):
+    """Use the given JSON library to decode payloads, or the fastest one
+    installed."""
+    global backend, loads
+    for candidate in ([name] if name else BACKENDS):
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            if name:
+                raise ValueError('JSON library "%s" is not installed' % name)
+            continue
+        backend = candidate
+        loads = module.loads
+        return backend
+
+
+set_backend()
+
+
+def extract(data, fields):
+    """Returns: a copy of data restricted to fields, a list of dotted paths
+    such as "change.owner.username"."""
+    slim = {}
+    for field in fields:
+        keys = field.split('.')
+        src, dst = data, slim
+        for key in keys[:-1]:
+            src = src.get(key)
+            if not isinstance(src, dict):
+                break
+            dst = dst.setdefault(key, {})
+        else:
+            if keys[-1] in src:
+                dst[keys[-1]] = src[keys[-1]]
+    return slim
+
+
+class Message(object):
+    """A firehose message, whose payload is decoded at most once whatever
+    the number of hooks looking at it.
+
+    If fields is set, only these fields of the payload are kept once
+    decoded. The raw payload is dropped once decoded, unless keep_payload
+    is set.
+
+    The decoded payload is shared by all the hooks, possibly running
+    concurrently: it must not be modified."""
+
+    __slots__ = ('topic', 'payload', 'fields', 'received', 'keep_payload',
+                 '_data')
+
+    def __init__(self, topic, payload, fields=None, keep_payload=False):
+        self.topic = topic
+        self.payload = payload
+        self.fields = fields
+        self.received = time.time()
+        self.keep_payload = keep_payload
+        self._data = None
+
+    def data(self):
+        if self._data is None:
+            data = loads(self.payload)
+            if self.fields is not None and isinstance(data, dict):
+                data = extract(data, self.fields)
+            self._data = data
+            if not self.keep_payload:
+                self.payload = None
+        return self._data
+
+
+def decode(msg, fields=None):
+    """Returns: the decoded payload of msg, restricted to fields if msg is
+    not a Message."""
+    if isinstance(msg, Message):
+        return msg.data()
+    data = loads(msg.payload)
+    if fields is not None and isinstance(data, dict):
+        data = extract(data, fields)
+    return data
@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import collections
+import itertools
+import logging
+import threading
+import time
+
+from firehooks import cluster
+from firehooks import decoder
+
+LOGGER = logging.getLogger('firehooks')
+
+PRIORITIES = ('high', 'normal', 'low')
+# stride scheduling: a hook's pass value grows by STRIDE / weight every time
+# it is served, the hook with the lowest pass value is served first.
+STRIDE = 10000.0
+
+
+def priority_class(priority):
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        raise ValueError('Unknown priority "%s", expected one of %s' % (
+            priority, ', '.join(PRIORITIES)))
+
+
+class Scheduler(object):
+    """Orders the work submitted to hooks.
+
+    Work is first ordered by priority class; the class of a message is the
+    highest of its hook's priority and its event type's priority. Within a
+    class, hooks are served with weighted fair queuing (stride scheduling)
+    so that a busy hook cannot starve the others. A hook processes one
+    batch of messages at a time, and messages of the same class are
+    processed in the order they were received; within a batch, messages
+    are always in the order they were received.
+
+    Priorities never reorder the messages of a change (see
+    cluster.change_key) for a hook: when a message is submitted, the
+    messages of the same change waiting in lower classes are moved up to
+    its class."""
+
+    def __init__(self, events=None):
+        self.events = dict((event, priority_class(p))
+                           for event, p in (events or {}).items())
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._queues = {}
+        # per hook and class: change key -> number of queued messages
+        self._keys = {}
+        self._priorities = {}
+        self._weights = {}
+        self._pass = {}
+        self._batching = {}
+        self._vtime = 0.0
+        self._busy = set()
+        self._closed = False
+
+    def register(self, hook, priority='normal', weight=1, batch_size=1,
+                 batch_latency=0):
+        if weight <= 0:
+            raise ValueError('Hook weight must be positive')
+        if batch_size < 1:
+            raise ValueError('Hook batch size must be at least 1')
+        self._priorities[hook] = priority_class(priority)
+        self._weights[hook] = float(weight)
+        self._batching[hook] = (batch_size, batch_latency)
+        self._pass[hook] = 0.0
+        self._queues[hook] = [collections.deque() for p in PRIORITIES]
+        self._keys[hook] = [collections.Counter() for p in PRIORITIES]
+
+    def pending(self, hook=None):
+        with self._cond:
+            hooks = [hook] if hook else self._queues
+            return sum(len(q) for h in hooks for q in self._queues[h])
+
+    def oldest(self):
+        """Returns: how long, in seconds, the oldest queued message has been
+        waiting for a worker, 0 if nothing is queued"""
+        with self._cond:
+            submitted = [q[0][3] for queues in self._queues.values()
+                         for q in queues if q]
+        if not submitted:
+            return 0.0
+        return max(time.time() - min(submitted), 0.0)
+
+    def submit(self, hook, msg, event=None, key=None):
+        """key identifies the change msg is about, if any."""
+        cls = min(self._priorities[hook],
+                  self.events.get(event, len(PRIORITIES) - 1))
+        with self._cond:
+            queues = self._queues[hook]
+            if not any(queues):
+                # an idle hook does not get to catch up on the time it was
+                # idle
+                self._pass[hook] = max(self._pass[hook], self._vtime)
+            if key is not None:
+                self._promote(hook, key, cls)
+                self._keys[hook][cls][key] += 1
+            queues[cls].append((next(self._seq), key, msg, time.time()))
+            # wake up idle workers as well as workers filling up a batch
+            self._cond.notify_all()
+
+    def _promote(self, hook, key, cls):
+        """Move the messages of change key queued in classes lower than
+        cls to cls."""
+        queues, keys = self._queues[hook], self._keys[hook]
+        moved = []
+        for lower in range(cls + 1, len(PRIORITIES)):
+            if keys[lower][key]:
+                moved.extend(i for i in queues[lower] if i[1] == key)
+                queues[lower] = collections.deque(
+                    i for i in queues[lower] if i[1] != key)
+                keys[cls][key] += keys[lower].pop(key)
+        if moved:
+            queues[cls] = collections.deque(
+                sorted(list(queues[cls]) + moved, key=lambda i: i[0]))
+
+    def _select(self):
+        best = None
+        for hook, queues in self._queues.items():
+            if hook in self._busy:
+                continue
+            for cls, queue in enumerate(queues):
+                if queue:
+                    key = (cls, self._pass[hook], queue[0][0])
+                    if best is None or key < best[0]:
+                        best = (key, hook)
+                    break
+        return best
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def get(self, timeout=None):
+        """Block until some work is available, or for at most timeout
+        seconds if set.
+
+        Returns: a (hook, messages) tuple, or None once the scheduler is
+        closed and nothing is queued, or on timeout"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                if self._closed and not any(
+                        q for queues in self._queues.values()
+                        for q in queues):
+                    return None
+                best = self._select()
+                if best is not None:
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            (cls, _pass, seq), hook = best
+            self._busy.add(hook)
+            queues = self._queues[hook]
+            batch_size, batch_latency = self._batching[hook]
+            if batch_size > 1:
+                deadline = time.time() + batch_latency
+                while not self._closed and\
+                        sum(len(q) for q in queues) < batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            batch = []
+            keys = self._keys[hook]
+            for c in list(range(cls, len(PRIORITIES))) + list(range(cls)):
+                queue = queues[c]
+                while queue and len(batch) < batch_size:
+                    item = queue.popleft()
+                    if item[1] is not None:
+                        keys[c][item[1]] -= 1
+                        if not keys[c][item[1]]:
+                            del keys[c][item[1]]
+                    batch.append(item)
+            batch.sort(key=lambda item: item[0])
+            self._vtime = _pass
+            self._pass[hook] = _pass + \
+                len(batch) * STRIDE / self._weights[hook]
+            return hook, [item[2] for item in batch]
+
+    def done(self, hook):
+        with self._cond:
+            self._busy.discard(hook)
+            self._cond.notify()
+
+    def close(self):
+        """Stop accepting work. The queued work is still served."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def clear(self):
+        """Drop the queued work.
+
+        Returns: the number of messages dropped, per hook"""
+        with self._cond:
+            dropped = {}
+            for hook, queues in self._queues.items():
+                dropped[hook] = sum(len(q) for q in queues)
+                for queue in queues:
+                    queue.clear()
+                for keys in self._keys[hook]:
+                    keys.clear()
+            self._cond.notify_all()
+            return dropped
+
+
+class LagStats(object):
+    """Tracks how far behind real time events are processed, per hook.
+
+    The dequeue lag is the age of an event when a worker picks it up, the
+    completion lag its age once the hook is done with it. Both are
+    exponentially weighted moving averages."""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.dequeue_lag = 0.0
+        self.hooks = {}
+        self._lock = threading.Lock()
+
+    def _average(self, stats, name, value):
+        if name in stats:
+            stats[name] += self.alpha * (value - stats[name])
+        else:
+            stats[name] = value
+
+    def observe_dequeue(self, hook, dequeue_lag):
+        """Called when a worker picks the event up."""
+        with self._lock:
+            stats = self.hooks.setdefault(hook, {'processed': 0})
+            self._average(stats, 'dequeue_lag', dequeue_lag)
+            self.dequeue_lag += self.alpha * (dequeue_lag - self.dequeue_lag)
+
+    def observe_completion(self, hook, completion_lag):
+        """Called once the hook is done with the event."""
+        with self._lock:
+            stats = self.hooks.setdefault(hook, {'processed': 0})
+            self._average(stats, 'completion_lag', completion_lag)
+            stats['max_completion_lag'] = max(
+                stats.get('max_completion_lag', completion_lag),
+                completion_lag)
+            stats['processed'] += 1
+
+    def observe(self, hook, dequeue_lag, completion_lag):
+        self.observe_dequeue(hook, dequeue_lag)
+        self.observe_completion(hook, completion_lag)
+
+    def snapshot(self):
+        with self._lock:
+            return {'lag': self.dequeue_lag,
+                    'hooks': dict((h, dict(s))
+                                  for h, s in self.hooks.items())}
+
+
+class Dispatcher(object):
+    """Runs the hooks matching incoming messages in a pool of workers.
+
+    If max_workers is greater than min_workers, the pool is resized every
+    scale_interval seconds: a worker is added while events wait for more
+    than target_lag seconds before being processed, and removed when the
+    lag is back under half the target or nothing is pending. The lag is
+    the highest of the average dequeue lag and of how long the oldest
+    queued event has been waiting, so that busy workers that do not pick
+    up new events still count as lag.
+
+    As a hook processes one batch at a time, at most one worker per
+    registered hook can be busy: the pool never grows beyond the number
+    of hooks, so scaling only helps with many hook entries.
+
+    Statistics about the lag and the pool are passed to on_stats, if set,
+    every scale_interval seconds."""
+
+    def __init__(self, workers=1, events=None, profiler=None, store=None,
+                 min_workers=None, max_workers=None, target_lag=60,
+                 scale_interval=10, drain_timeout=30):
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.min_workers = min_workers or workers
+        self.max_workers = max(max_workers or workers, self.min_workers)
+        self.target_lag = target_lag
+        self.scale_interval = scale_interval
+        self.scheduler = Scheduler(events)
+        self.profiler = profiler
+        self.store = store
+        self.lag = LagStats()
+        self.on_stats = None
+        self.hooks = []
+        self.names = {}
+        # payload fields needed by the hooks, None if they need everything
+        self.fields = set(('eventCreatedOn', ) + cluster.CHANGE_FIELDS)
+        self._threads = []
+        self._retiring = 0
+        self._worker_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._controller = None
+        if store is not None:
+            self.require(store.payload_fields)
+
+    def require(self, fields):
+        """Keep these payload fields when decoding messages, all the fields
+        if None."""
+        if fields is None:
+            self.fields = None
+        elif self.fields is not None:
+            self.fields.update(fields)
+
+    def message(self, msg):
+        """Wrap an MQTT message so that it is decoded only once."""
+        if isinstance(msg, decoder.Message):
+            return msg
+        # the profiler captures the raw payloads of slow events
+        return decoder.Message(msg.topic, msg.payload, self.fields,
+                               keep_payload=self.profiler is not None)
+
+    def register(self, hook, name=None, index=None):
+        """Hooks can be given a "priority" (high, normal or low) and a
+        "weight" in their configuration. See base.Hook about batching.
+
+        name and index identify the hook in the configuration's hook
+        table."""
+        self.scheduler.register(hook,
+                                priority=hook.config.get('priority',
+                                                         'normal'),
+                                weight=hook.config.get('weight', 1),
+                                batch_size=getattr(hook, 'batch_size', 1),
+                                batch_latency=getattr(hook, 'batch_latency',
+                                                      0))
+        self.require(getattr(hook, 'payload_fields', None))
+        self.hooks.append(hook)
+        self.names[hook] = (name or hook.__class__.__name__, index)
+
+    def dispatch(self, msg):
+        msg = self.message(msg)
+        event = msg.topic.rsplit('/', 1)[-1]
+        accepted = []
+        for h in self.hooks:
+            try:
+                if h.filter(msg):
+                    accepted.append(h)
+            except Exception as e:
+                m = 'Unknown error filtering message with hook %s: %s'
+                LOGGER.exception(m % (h.__class__.__name__, e))
+        if not accepted:
+            return
+        # the store only follows the changes some hook cares about, and is
+        # up to date before the hooks run
+        if self.store is not None and msg.topic.startswith('gerrit/'):
+            self.store.feed(msg)
+        # keeps the events of a change in order
+        key = cluster.change_key(msg)
+        for h in accepted:
+            self.scheduler.submit(h, msg, event, key)
+
+    def label(self, hook):
+        name, index = self.names[hook]
+        if index is None:
+            return name
+        return '%s[%i]' % (name, index)
+
+    @property
+    def pool_size(self):
+        with self._lock:
+            return len(self._threads) - self._retiring
+
+    def current_lag(self):
+        """Returns: the dispatcher lag, in seconds, see Dispatcher"""
+        return max(self.lag.dequeue_lag, self.scheduler.oldest())
+
+    def stats(self):
+        stats = self.lag.snapshot()
+        stats.update({'lag': self.current_lag(),
+                      'oldest_pending': self.scheduler.oldest(),
+                      'workers': self.pool_size,
+                      'pending': self.scheduler.pending(),
+                      'target_lag': self.target_lag})
+        return stats
+
+    def check_pool(self):
+        """Warn about pool sizes the registered hooks cannot use."""
+        hooks = len(self.hooks)
+        if max(self.workers, self.max_workers) > hooks:
+            LOGGER.warning(
+                'At most %i worker(s) can be busy with %i hook(s) registered, '
+                'as a hook processes one batch at a time: workers %i, '
+                'max_workers %i' % (hooks, hooks, self.workers,
+                                    self.max_workers))
+        if self.min_workers < self.max_workers and self.min_workers >= hooks:
+            LOGGER.warning(
+                'The worker pool will not grow: min_workers (%i) is already '
+                'the number of hooks (%i)' % (self.min_workers, hooks))
+
+    def start(self):
+        self.check_pool()
+        self._stopping.clear()
+        for i in range(self.workers):
+            self._spawn()
+        self._controller = threading.Thread(target=self._control,
+                                            name='firehooks-controller')
+        self._controller.daemon = True
+        self._controller.start()
+
+    def stop(self):
+        """Stop once the queued work is done, or after drain_timeout
+        seconds, dropping what is left."""
+        self._stopping.set()
+        self.scheduler.close()
+        if self._controller is not None:
+            self._controller.join()
+            self._controller = None
+        deadline = time.time() + self.drain_timeout
+        with self._lock:
+            threads = list(self._threads)
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+        for hook, count in self.scheduler.clear().items():
+            if count:
+                LOGGER.warning('Stopping: dropped %i queued message(s) of '
+                               'hook %s' % (count, self.label(hook)))
+        # workers exit once done with their current batch
+        with self._lock:
+            self._threads = []
+
+    def _spawn(self):
+        with self._lock:
+            t = threading.Thread(
+                target=self._work,
+                name='firehooks-worker-%i' % next(self._worker_ids))
+            t.daemon = True
+            self._threads.append(t)
+        t.start()
+
+    def _retire(self):
+        """Returns: whether the current worker must exit"""
+        with self._lock:
+            if not self._retiring:
+                return False
+            self._retiring -= 1
+            if threading.current_thread() in self._threads:
+                self._threads.remove(threading.current_thread())
+            return True
+
+    def resize(self):
+        """Grow or shrink the worker pool according to the lag."""
+        if self.max_workers == self.min_workers:
+            return
+        lag = self.current_lag()
+        pending = self.scheduler.pending()
+        size = self.pool_size
+        # a hook processes one batch at a time, more workers than hooks
+        # would stay idle
+        ceiling = min(self.max_workers, max(len(self.hooks), 1))
+        if lag > self.target_lag and pending and size < ceiling:
+            LOGGER.info('Lag is %.1fs, %i pending: adding a worker (%i)' % (
+                lag, pending, size + 1))
+            self._spawn()
+        elif (not pending or lag < self.target_lag / 2.0) and\
+                size > self.min_workers:
+            LOGGER.info('Lag is %.1fs, %i pending: removing a worker (%i)'
+                        % (lag, pending, size - 1))
+            with self._lock:
+                self._retiring += 1
+
+    def _control(self):
+        while not self._stopping.wait(self.scale_interval):
+            try:
+                self.resize()
+                if self.on_stats is not None:
+                    self.on_stats(self.stats())
+            except Exception as e:
+                LOGGER.exception('Error in the dispatcher controller: %s' % e)
+
+    @staticmethod
+    def created_on(msg):
+        """Returns: when the event was created, or received if unknown"""
+        try:
+            created = decoder.decode(msg).get('eventCreatedOn')
+            if created:
+                return float(created)
+        except Exception:
+            pass
+        return getattr(msg, 'received', time.time())
+
+    def _work(self):
+        while True:
+            if self._retire():
+                return
+            work = self.scheduler.get(timeout=1)
+            if work is None:
+                if self.scheduler.closed:
+                    return
+                continue
+            hook, msgs = work
+            created = [self.created_on(m) for m in msgs]
+            label = self.label(hook)
+            dequeued = time.time()
+            for c in created:
+                self.lag.observe_dequeue(label, dequeued - c)
+            try:
+                if self.profiler:
+                    name, index = self.names[hook]
+                    self.profiler.run(hook, name, index, msgs)
+                else:
+                    hook.process_batch(msgs)
+            except Exception as e:
+                m = 'Unknown error running hook %s: %s'
+                LOGGER.exception(m % (hook.__class__.__name__, e))
+            finally:
+                self.scheduler.done(hook)
+                completed = time.time()
+                for c in created:
+                    self.lag.observe_completion(label, completed - c)
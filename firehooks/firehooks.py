@@ -16,45 +16,185 @@
 # under the License.
 
 
-import paho.mqtt.client as mqtt
 import argparse
+import json
 import logging
-from stevedore import driver
+from . import cluster as _cluster
 from . import config
+from . import decoder
+from . import loadgen
+from . import profiling
+from .dispatcher import Dispatcher
+from .store import ChangeStore
 from .softwarefactory import SoftwareFactory
+import signal
 import sys
+import time
 
 
 LOGGER = logging.getLogger('firehooks')
 
+# Heavy dependencies (paho, stevedore, the hook plugins and their client
+# libraries) are imported only when they are actually needed, so that
+# firehooks starts fast whatever the configured hooks are. See
+# firehooks.tests.test_imports.
 
-def load_hook(conf, name, SF):
-    hook_class = driver.DriverManager(namespace='firehooks.hooks',
-                                      name=name,
-                                      invoke_on_load=False).driver
-    hook = hook_class(**conf)
+# hook classes, resolved once per hook name
+_DRIVERS = {}
+
+
+class Terminated(KeyboardInterrupt):
+    """Raised in the main thread on SIGTERM (e.g. systemctl stop), so that
+    firehooks shuts down as on a manual interruption: queues drained, change
+    state and batched reviews flushed."""
+
+
+def on_sigterm(signum, frame):
+    raise Terminated()
+
+
+def get_driver(name):
+    if name not in _DRIVERS:
+        from stevedore import driver
+        try:
+            _DRIVERS[name] = driver.DriverManager(namespace='firehooks.hooks',
+                                                  name=name,
+                                                  invoke_on_load=False).driver
+        except RuntimeError as e:
+            raise config.ConfigError('Unknown hook "%s": %s' % (name, e))
+    return _DRIVERS[name]
+
+
+def compile_hooks(conf):
+    """Resolve the hooks of a configuration into a list of
+    (name, hook class, hook config), so that entry points are looked up once
+    per hook name rather than once per configured hook."""
+    table = []
+    hks_conf = conf.config.get('hooks', {})
+    for hook_name in hks_conf:
+        hook_class = get_driver(hook_name)
+        for hook_config in hks_conf[hook_name]:
+            table.append((hook_name, hook_class, hook_config))
+    return table
+
+
+def load_hook(conf, name, SF, store=None, hook_class=None):
+    """hook_class is looked up by name if not given."""
+    hook = (hook_class or get_driver(name))(**conf)
     hook.SF = SF
+    hook.store = store
     LOGGER.debug('Hook "%s" loaded' % name)
     return hook
 
 
+def replay(path, hook_table, SF, live=False):
+    """Process a captured event again with the hook that captured it.
+
+    Unless live is set, the hook can only read from the services while
+    processing the event: its writes fail, so that the replay does not
+    act on the services again (comments, autoholds, Taiga updates...).
+    The hook itself is set up normally (e.g. logged in to Taiga)."""
+    import cProfile
+    import pstats
+    event, msgs = profiling.load_capture(path)
+    index = event['index']
+    if index is None or index >= len(hook_table) or\
+            hook_table[index][0] != event['hook']:
+        sys.exit('Hook "%s" of capture %s not found in the configuration'
+                 % (event['hook'], path))
+    hook_name, hook_class, hook_config = hook_table[index]
+    try:
+        hook = load_hook(hook_config, hook_name, SF, hook_class=hook_class)
+    except Exception as e:
+        sys.exit('Could not load hook "%s": %s' % (hook_name, e))
+    msgs = [msg for msg in msgs if hook.filter(msg)]
+    LOGGER.info('Replaying %i message(s) with hook %s%s '
+                '(originally took %.2fs)' % (
+                    len(msgs), hook_name, '' if live else ' offline',
+                    event['duration']))
+    profile = cProfile.Profile()
+    start = time.time()
+    with profiling.offline(not live):
+        try:
+            profile.runcall(hook.process_batch, msgs)
+        except Exception as e:
+            LOGGER.exception('Hook %s failed: %s' % (hook_name, e))
+    LOGGER.info('Replay took %.2fs' % (time.time() - start))
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(30)
+
+
+def run_loadgen(args, dispatcher):
+    """Find the highest rate of synthetic events the hooks sustain."""
+    generator = loadgen.EventGenerator(projects=args.projects,
+                                       changes=args.changes,
+                                       project_name=args.project_name,
+                                       seed=args.seed)
+    publish = None
+    client = None
+    if args.via_broker:
+        import paho.mqtt.client as mqtt
+        prefix = loadgen.TOPIC_PREFIX
+
+        def _on_message(client, userdata, msg):
+            msg = dispatcher.message(msg)
+            msg.topic = msg.topic[len(prefix):]
+            dispatcher.dispatch(msg)
+
+        def _publish(topic, payload):
+            client.publish(prefix + topic, payload)
+
+        LOGGER.info('Publishing synthetic events on %s:%i under %s' % (
+            args.broker, args.port, prefix))
+        client = mqtt.Client()
+        client.on_message = _on_message
+        client.connect(args.broker, args.port, 60)
+        client.subscribe(prefix + 'gerrit/#')
+        client.loop_start()
+        publish = _publish
+
+    test = loadgen.LoadTest(dispatcher, generator, publish,
+                            start_rate=args.rate, step=args.rate_step,
+                            max_rate=args.max_rate,
+                            duration=args.step_duration,
+                            max_lag=args.max_lag)
+    try:
+        sustained = test.run()
+    finally:
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+    print('%10s %8s %8s %8s %8s' % ('events/s', 'sent', 'lag', 'pending',
+                                    'workers'))
+    for r in test.results:
+        print('%10g %8i %7.2fs %8i %8i%s' % (
+            r['rate'], r['sent'], r['lag'], r['pending'], r['workers'],
+            '' if r['sustained'] else '  lagging'))
+    if sustained:
+        print('Highest sustained rate: %g events/s' % sustained)
+    else:
+        print('No rate was sustained')
+
+
 # Assign a callback for connect
-def on_connect(client, userdata, flags, rc):
-    LOGGER.info("MQTT: Connected with result code "+str(rc))
-    client.subscribe("#")
+def on_connect(cluster=None):
+    def _on_connect(client, userdata, flags, rc):
+        LOGGER.info("MQTT: Connected with result code "+str(rc))
+        if cluster:
+            cluster.on_connect(client)
+            client.subscribe(cluster.subscription)
+        else:
+            client.subscribe("#")
+    return _on_connect
 
 
-def on_message(hooks):
+def on_message(dispatcher, cluster=None):
     def _on_message(client, userdata, msg):
         LOGGER.debug(msg.topic)
-        # TODO find a way to parallelize this. multiprocessing does not work
-        # due to pickling issues
-        for h in hooks:
-            try:
-                h(msg)
-            except Exception as e:
-                msg = 'Unknown error running hook %s: %s'
-                LOGGER.exception(msg % (h.__class__.__name__, e))
+        msg = dispatcher.message(msg)
+        if cluster:
+            if cluster.handle_membership(msg) or not cluster.owns(msg):
+                return
+        dispatcher.dispatch(msg)
     return _on_message
 
 
@@ -67,17 +207,69 @@ def main():
 
     broker = None
     port = None
-    hooks = {}
 
     parser = argparse.ArgumentParser(description="Firehooks")
     parser.add_argument('--config', '-c', help='The configuration file')
     parser.add_argument('--verbose', '-v', default=False, action='store_true',
                         help='Run in debug mode')
+    parser.add_argument('--replay', metavar='CAPTURE_DIR',
+                        help='Replay an event captured by the profiler')
+    parser.add_argument('--live', default=False, action='store_true',
+                        help='Let the replayed hook write to the services '
+                             '(post comments, update items...) again. '
+                             'Required by loadgen, whose hooks act on the '
+                             'services too')
+    parser.add_argument('mode', nargs='?', default='run',
+                        choices=('run', 'loadgen'),
+                        help='Consume the firehose (run, the default) or '
+                             'load test the configured hooks with synthetic '
+                             'events (loadgen). Hooks act on these events: '
+                             'load test a staging configuration, with '
+                             '--live.')
+    lg = parser.add_argument_group('loadgen')
+    lg.add_argument('--rate', type=float, default=10,
+                    help='Initial rate, in events per second')
+    lg.add_argument('--rate-step', type=float, default=10,
+                    help='Increase of the rate at every step')
+    lg.add_argument('--max-rate', type=float, default=1000,
+                    help='Stop at this rate')
+    lg.add_argument('--step-duration', type=float, default=30,
+                    help='Duration of a step, in seconds')
+    lg.add_argument('--max-lag', type=float, default=1.0,
+                    help='Highest lag, in seconds, of a sustained rate')
+    lg.add_argument('--projects', type=int, default=10,
+                    help='Number of projects')
+    lg.add_argument('--changes', type=int, default=1000,
+                    help='Number of changes open at any time')
+    lg.add_argument('--project-name', default='loadgen-%i',
+                    help='Pattern of the project names, "%%i" being '
+                         'replaced with the project index')
+    lg.add_argument('--seed', type=int,
+                    help='Seed of the event generator')
+    lg.add_argument('--via-broker', default=False, action='store_true',
+                    help='Publish the events to --broker, under the '
+                         '"%s" topic prefix, instead of dispatching them '
+                         'directly' % loadgen.TOPIC_PREFIX)
+    lg.add_argument('--broker', default='localhost',
+                    help='Broker used with --via-broker, never the '
+                         'configured one (default: localhost)')
+    lg.add_argument('--port', type=int, default=1883,
+                    help='Port of the broker used with --via-broker')
 
     args = parser.parse_args()
     if not args.config:
         sys.exit('Please specify a path to a valid configuration file.')
-    conf = config.Config(args.config)
+    loadgen_mode = args.mode == 'loadgen' and not args.replay
+    if loadgen_mode and not args.live:
+        sys.exit('The configured hooks act on the synthetic events of '
+                 'loadgen as on real ones (autoholds, comments, tracker '
+                 'updates...): use a staging configuration, and set --live '
+                 'to confirm.')
+    try:
+        conf = config.Config(args.config)
+        hook_table = compile_hooks(conf)
+    except config.ConfigError as e:
+        sys.exit('Invalid configuration file %s: %s' % (args.config, e))
     if args.verbose:
         console.setLevel(logging.DEBUG)
     else:
@@ -93,28 +285,103 @@ def main():
     # SF
     SF = SoftwareFactory(**conf.config['software-factory'])
 
+    if 'decoder' in conf.config:
+        try:
+            decoder.set_backend(conf.config['decoder'])
+        except ValueError as e:
+            sys.exit('Invalid decoder: %s' % e)
+    LOGGER.debug('Decoding payloads with %s' % decoder.backend)
+
+    if args.replay:
+        replay(args.replay, hook_table, SF, args.live)
+        return
+
+    # Profiling, never of synthetic events
+    profiler = None
+    if 'profiling' in conf.config and not loadgen_mode:
+        profiler = profiling.Profiler(**conf.config['profiling'])
+
+    # Change state, kept in memory only for synthetic events
+    if loadgen_mode:
+        store = ChangeStore()
+    else:
+        store = ChangeStore(**conf.config.get('state', {}))
+
     # hooks
-    hooks = []
-    hks_conf = conf.config.get('hooks', {})
-    for hook_name in hks_conf:
-        for hook_config in hks_conf[hook_name]:
-            h = load_hook(hook_config, hook_name, SF)
-            hooks.append(h)
+    try:
+        dispatcher = Dispatcher(profiler=profiler, store=store,
+                                **conf.config.get('scheduling', {}))
+        for index, (hook_name, hook_class, hook_config) in\
+                enumerate(hook_table):
+            h = load_hook(hook_config, hook_name, SF, store, hook_class)
+            dispatcher.register(h, hook_name, index)
+    except ValueError as e:
+        sys.exit('Invalid scheduling configuration: %s' % e)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    dispatcher.start()
+
+    if loadgen_mode:
+        try:
+            run_loadgen(args, dispatcher)
+        except ValueError as e:
+            sys.exit('Invalid load test: %s' % e)
+        finally:
+            dispatcher.stop()
+            store.close()
+            SF.flush_reviews()
+        return
+
+    # Clustering
+    cluster = None
+    if 'cluster' in conf.config:
+        cluster = _cluster.Cluster(**conf.config['cluster'])
+        LOGGER.info('Running as member "%s" of cluster "%s" (%s mode)' % (
+            cluster.name, cluster.group, cluster.mode))
+        if cluster.mode == 'shared':
+            LOGGER.warning('Cluster in shared mode: the events of a change '
+                           'may be handled out of order, by several '
+                           'instances%s' % (
+                               ', each with a partial change state'
+                               if 'state' in conf.config else ''))
+        dispatcher.require(cluster.payload_fields)
 
     # Setup the MQTT client
+    import paho.mqtt.client as mqtt
     client = mqtt.Client()
+    if cluster:
+        cluster.setup(client)
     client.connect(broker, port, 60)
 
+    # Monitoring
+    if 'monitoring' in conf.config:
+        stats_topic = conf.config['monitoring'].get('topic',
+                                                    'firehooks/stats')
+        if cluster:
+            stats_topic += '/' + cluster.name
+
+        def publish_stats(stats):
+            LOGGER.debug('Dispatcher stats: %r' % stats)
+            client.publish(stats_topic, json.dumps(stats))
+
+        dispatcher.on_stats = publish_stats
+
     # Callbacks
-    client.on_connect = on_connect
-    client.on_message = on_message(hooks)
+    client.on_connect = on_connect(cluster)
+    client.on_message = on_message(dispatcher, cluster)
 
     # Loop the client forever
     try:
         client.loop_forever()
-    except KeyboardInterrupt:
-        LOGGER.info('Manual interruption, bye!')
-        sys.exit(2)
+    except KeyboardInterrupt as e:
+        terminated = isinstance(e, Terminated)
+        LOGGER.info('%s, bye!' % ('Terminated' if terminated
+                                  else 'Manual interruption'))
+        dispatcher.stop()
+        store.close()
+        SF.flush_reviews()
+        if cluster:
+            cluster.leave(client)
+        sys.exit(0 if terminated else 2)
 
 
 if __name__ == '__main__':
@@ -18,19 +18,36 @@
 
 import six
 import abc
-import json
 import logging
 import re
 
+from firehooks import decoder
+
+
+GERRIT_TOPIC = re.compile('gerrit/(?P<project_repo>[A-Za-z0-9-_/]+)'
+                          '/(?P<event>[A-Za-z0-9-_]+)$', re.I)
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Hook(object):
-    """The base for all hooks."""
+    """The base for all hooks.
+
+    Hooks that can amortize work over several messages override
+    process_batch(). The dispatcher then hands them up to "batch_size"
+    messages at a time, waiting at most "batch_latency" seconds for a batch
+    to fill up. Both can be set in the hook's configuration."""
+
+    batch_size = 1
+    batch_latency = 0.1
+    # firehooks.store.ChangeStore shared by the hooks, set when loading them
+    store = None
 
     def __init__(self, **config):
         """Prepare what's needed by the hook."""
         self.config = config
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.batch_size = config.get('batch_size', self.batch_size)
+        self.batch_latency = config.get('batch_latency', self.batch_latency)
 
     def filter(self, msg):
         """Finds out whether the hook applies to the message or not.
@@ -39,8 +56,22 @@ class Hook(object):
         self.logger.debug('Filtering msg: %s' % msg)
 
     def process(self, msg):
-        """The actual action covered by the hook."""
-        self.logger.debug('Processing msg: %s' % msg.payload)
+        """The actual action covered by the hook.
+
+        The payload of msg is shared with the other hooks: it must not be
+        modified."""
+        self.logger.debug('Processing msg: %s' % msg.topic)
+
+    def process_batch(self, msgs):
+        """Process messages that passed the filter, in the order they were
+        received. By default, a failure on a message does not prevent the
+        next ones from being processed."""
+        for msg in msgs:
+            try:
+                self.process(msg)
+            except Exception as e:
+                self.logger.exception('Could not process message on %s: %s'
+                                      % (getattr(msg, 'topic', msg), e))
 
     def __call__(self, msg):
         if self.filter(msg):
@@ -49,13 +80,17 @@ class Hook(object):
 
 @six.add_metaclass(abc.ABCMeta)
 class GerritHook(Hook):
-    """Hooks based on Gerrit events."""
+    """Hooks based on Gerrit events.
+
+    Hooks only needing a few fields of the events' payloads can list them
+    in payload_fields, as dotted paths such as "change.owner.username",
+    so that the rest of the payload is not kept in memory."""
+
+    payload_fields = None
 
     def __init__(self, **config):
         super(GerritHook, self).__init__(**config)
-        _topic_filter = ('gerrit/(?P<project_repo>[A-Za-z0-9-_/]+)'
-                         '/(?P<event>[A-Za-z0-9-_]+)$')
-        self.topic_filter = re.compile(_topic_filter, re.I)
+        self.topic_filter = GERRIT_TOPIC
 
     def filter(self, msg):
         super(GerritHook, self).filter(msg)
@@ -71,7 +106,7 @@ class GerritHook(Hook):
         else:
             project = project_repo
             repo = project_repo
-        payload = json.loads(msg.payload)
+        payload = decoder.decode(msg, self.payload_fields)
         return project, repo, payload, event
 
     def process(self, msg):
@@ -15,21 +15,214 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import json
 import re
+import threading
 
+import requests
 from taiga import TaigaAPI
 from taiga.exceptions import TaigaRestException
 from taiga.models import Issue as TaigaIssue
 from taiga.models import Task as TaigaTask
 from taiga.models import UserStory as TaigaUserStory
+from taiga.requestmaker import RequestMaker
 
+from firehooks import profiling
 from firehooks.hooks import base
+from firehooks.httpcache import HTTPCache
+
+
+CLOSES_REGEX = re.compile(r'Closes: #?(?P<issue>\d+)', re.I)
+TAIGA_REGEX = re.compile(r'TG-(?P<issue>\d+)\s*(?P<status>#[a-zA-Z-]+)?',
+                         re.I)
+
+
+# history entity of the items of each endpoint
+HISTORY = {TaigaIssue.endpoint: 'issue',
+           TaigaTask.endpoint: 'task',
+           TaigaUserStory.endpoint: 'userstory'}
+
+# threads handling the references of commit messages, shared by the hooks
+FANOUT_THREADS = 16
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            from multiprocessing.pool import ThreadPool
+            _POOL = ThreadPool(FANOUT_THREADS)
+        return _POOL
+
+
+# Taiga clients shared by the hooks, per (host, username, password)
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
 
 
 class RefException(Exception):
     """Triggered when an issue is not found on the tracker."""
 
 
+class SharedRequestMaker(RequestMaker):
+    """Sends the requests of a TaigaClient through a pooled session, no more
+    than max_concurrency at a time, and logs in again when the token has
+    expired."""
+
+    def __init__(self, client, api_path, host, token, token_type='Bearer',
+                 tls_verify=True):
+        super(SharedRequestMaker, self).__init__(api_path, host, token,
+                                                 token_type, tls_verify)
+        self.client = client
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=client.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.semaphore = threading.BoundedSemaphore(client.max_concurrency)
+
+    def _request(self, verb, uri, headers, parameters, **kwargs):
+        full_url = self.urljoin(self.host, self.api_path,
+                                uri.format(**parameters))
+        for attempt in range(2):
+            # headers are a callable, as they embed the current token
+            try:
+                with self.semaphore:
+                    result = self.session.request(
+                        verb, full_url, headers=headers(),
+                        verify=self.tls_verify,
+                        proxies=getattr(self, 'proxies', None),
+                        **kwargs)
+            except requests.RequestException:
+                raise TaigaRestException(full_url, 400, 'Network error!',
+                                         verb)
+            if result.status_code != 401 or attempt:
+                break
+            self.token = self.client.login()
+        if verb != 'GET':
+            self.invalidate(uri.format(**parameters), result)
+        if self.is_bad_response(result):
+            raise TaigaRestException(full_url, result.status_code,
+                                     result.text, verb)
+        return result
+
+    def invalidate(self, uri, result):
+        """Forget the cached reads a write to uri may change: the item
+        itself, its history and the lookups by ref of the items of the
+        same type in its project."""
+        cache = self.client.cache
+        cache.invalidate(self.urljoin(self.host, self.api_path, uri))
+        parts = uri.split('?')[0].strip('/').split('/')
+        if len(parts) < 2 or not parts[1].isdigit():
+            return
+        endpoint, item_id = parts[:2]
+        if endpoint in HISTORY:
+            cache.invalidate(self.urljoin(self.host, self.api_path,
+                                          'history', HISTORY[endpoint],
+                                          item_id))
+        try:
+            project = str(result.json()['project'])
+        except Exception:
+            # unknown project, forget the lookups in every project
+            project = None
+        by_ref = self.urljoin(self.host, self.api_path, endpoint, 'by_ref')
+        cache.invalidate_if(
+            lambda url, params: url == by_ref and
+            project in (None, params.get('project')))
+
+    def get(self, uri, query=None, cache=False, paginate=True, **parameters):
+        full_url = self.urljoin(self.host, self.api_path,
+                                uri.format(**parameters))
+
+        def send(headers, params):
+            headers.pop('paginate', None)
+
+            def _headers():
+                h = self.headers(paginate)
+                h.update(headers)
+                return h
+            return self._request('GET', uri, _headers, parameters,
+                                 params=params)
+
+        # the token is not part of the cache key, it does not change what
+        # the bot user can read
+        return self.client.cache.get(full_url, send,
+                                     headers={'paginate': str(paginate)},
+                                     params=query or {})
+
+    def post(self, uri, payload=None, query=None, files=None, **parameters):
+        if files:
+            def headers():
+                return {'Authorization': '%s %s' % (self.token_type,
+                                                    self.token),
+                        'x-disable-pagination': 'True'}
+            data = payload
+        else:
+            headers = self.headers
+            data = json.dumps(payload)
+            files = {}
+        return self._request('POST', uri, headers, parameters,
+                             data=data, params=query or {}, files=files)
+
+    def delete(self, uri, query=None, **parameters):
+        return self._request('DELETE', uri, self.headers, parameters,
+                             params=query or {})
+
+    def put(self, uri, payload=None, query=None, **parameters):
+        return self._request('PUT', uri, self.headers, parameters,
+                             data=json.dumps(payload), params=query or {})
+
+    def patch(self, uri, payload=None, query=None, **parameters):
+        return self._request('PATCH', uri, self.headers, parameters,
+                             data=json.dumps(payload), params=query or {})
+
+
+class TaigaClient(object):
+    """An authenticated Taiga API client, shared by all the hooks using the
+    same server and credentials. Use get_taiga_client() to get one."""
+
+    def __init__(self, host, username, password, max_concurrency=4,
+                 cache=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.max_concurrency = max_concurrency
+        self.cache = HTTPCache(**(cache or {}))
+        self._auth_lock = threading.Lock()
+        self.api = self._new_api()
+        self.api.auth(username=username, password=password)
+        self.api.raw_request = SharedRequestMaker(
+            self, '/api/v1', self.api.host, self.api.token,
+            tls_verify=self.api.tls_verify)
+        self.api._init_resources()
+
+    def _new_api(self):
+        if self.host:
+            return TaigaAPI(host=self.host)
+        return TaigaAPI()
+
+    def login(self):
+        """Returns: a fresh auth token"""
+        with self._auth_lock:
+            api = self._new_api()
+            api.auth(username=self.username, password=self.password)
+            self.api.token = api.token
+            return api.token
+
+
+def get_taiga_client(host, username, password, max_concurrency=4,
+                     cache=None):
+    key = (host, username, password)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = TaigaClient(host, username, password,
+                                        max_concurrency, cache)
+        return _CLIENTS[key]
+
+
 class BaseIssueTrackerHook(base.GerritHook):
     """Generic Issue Tracker Hook. It will trigger on gerrit events
     related to projects matching a specific regular expression."""
@@ -37,8 +230,11 @@ class BaseIssueTrackerHook(base.GerritHook):
     def __init__(self, **config):
         super(BaseIssueTrackerHook, self).__init__(**config)
         self.project_regex = re.compile(config['project'], re.I)
-        self.tracker_regex = re.compile(
-            'Closes: #?(?P<issue>\d+)', re.I)
+        self.tracker_regex = CLOSES_REGEX
+        self.max_fanout = config.get('max_fanout', 4)
+        # actions taken are remembered in the change store under this prefix
+        self.action_prefix = '%s:%s:' % (self.__class__.__name__,
+                                         config['project'])
 
     def filter(self, msg):
         if super(BaseIssueTrackerHook, self).filter(msg):
@@ -52,6 +248,55 @@ class BaseIssueTrackerHook(base.GerritHook):
                 return True
         return False
 
+    def find_refs(self, payload):
+        """Returns: the (issue, status) references found in the commit
+        message of the change, cached in the change store if any."""
+        change = payload.get('change', {})
+        commit_msg = change.get('commitMessage')
+        if self.store is not None:
+            return self.store.refs(change.get('number'), commit_msg,
+                                   self.tracker_regex)
+        return self.tracker_regex.findall(commit_msg)
+
+    def already_done(self, change_number, action):
+        if self.store is None:
+            return False
+        return self.store.done(change_number, self.action_prefix + action)
+
+    def remember(self, change_number, action):
+        if self.store is not None:
+            self.store.record(change_number, self.action_prefix + action)
+
+    def fan_out(self, update_ref, refs):
+        """Call update_ref(issue_id, status) for every reference found in a
+        commit message, concurrently with at most max_fanout references
+        handled at a time. Returns once all the references are handled; a
+        failure on one reference does not affect the others.
+
+        A reference found several times is handled once, with the first
+        status given to it if any."""
+        statuses = collections.OrderedDict()
+        for issue_id, status in refs:
+            if not statuses.get(issue_id):
+                statuses[issue_id] = status
+        unique_refs = list(statuses.items())
+
+        def _update_refs(refs):
+            for ref in refs:
+                try:
+                    update_ref(*ref)
+                except Exception as e:
+                    self.logger.exception(
+                        'Could not update ref #%s: %s' % (ref[0], e))
+
+        if len(unique_refs) <= 1 or self.max_fanout <= 1:
+            _update_refs(unique_refs)
+            return
+        # at most max_fanout tasks, each handling its share of the refs
+        tasks = [unique_refs[i::self.max_fanout]
+                 for i in range(min(self.max_fanout, len(unique_refs)))]
+        get_pool().map(profiling.bind(_update_refs), tasks)
+
     def on_patchset_created(self, project, repo, payload):
         self.logger.debug('processing "patchset-created" event')
 
@@ -68,16 +313,28 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
     The hook looks for the following pattern in commit messages:
     "TG-<id> [<status>]"
 
-    The hook will update the item's status as the gerrit review evolves."""
+    The hook will update the item's status as the gerrit review evolves.
+
+    Hooks configured with the same Taiga server ("host", defaults to
+    taiga.io) and credentials share one client, doing at most
+    "max_concurrency" concurrent requests, and caching what it reads as
+    set by "cache" (see firehooks.httpcache.HTTPCache)."""
+
+    payload_fields = ('change.commitMessage', 'change.subject',
+                      'change.owner.username', 'change.number', 'change.url',
+                      'patchSet.number', 'approvals', 'author.username')
 
     def __init__(self, **config):
         super(TaigaItemUpdateHook, self).__init__(**config)
-        self.api = TaigaAPI()
-        self.api.auth(username=config['auth']['username'],
-                      password=config['auth']['password'])
+        self.client = get_taiga_client(config.get('host'),
+                                       config['auth']['username'],
+                                       config['auth']['password'],
+                                       config.get('max_concurrency', 4),
+                                       config.get('cache'))
+        self.api = self.client.api
+        self.action_prefix = 'taiga:%s:' % config['taiga_project']
         self.project = self.api.projects.get_by_slug(config['taiga_project'])
-        self.tracker_regex = re.compile(
-            'TG-(?P<issue>\d+)\s*(?P<status>#[a-zA-Z-]+)?', re.I)
+        self.tracker_regex = TAIGA_REGEX
 
     def find_by_ref(self, ref):
         try:
@@ -106,7 +363,6 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
     def on_patchset_created(self, project, repo, payload):
         super(TaigaItemUpdateHook, self).on_patchset_created(
             project, repo, payload)
-        commit_msg = payload.get('change', {}).get('commitMessage')
         subject = payload.get('change', {}).get('subject')
         author = payload.get('change', {}).get('owner', {}).get('username') or\
             'UNKNOWN'
@@ -114,7 +370,12 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
         url = payload.get('change', {}).get('url')
         # prepare error msg
         m = 'status "%s" not found, using default status'
-        for issue_id, status in self.tracker_regex.findall(commit_msg):
+
+        def update_ref(issue_id, status):
+            action = 'created:%s' % issue_id
+            if self.already_done(patch_number, action):
+                self.logger.debug('Ref #%s up to date, skipping' % issue_id)
+                return
             ref = None
             # status irrelevant here, patchset creation sets issue/task/US as
             # in progress by default
@@ -131,8 +392,9 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
                 ref_history = self.get_ref_history(ref)
                 if any([comment in u.get('comment', '')
                         for u in ref_history]):
-                    self.debug('Ref #%s up to date, skipping' % ref.id)
-                    continue
+                    self.logger.debug('Ref #%s up to date, skipping' % ref.id)
+                    self.remember(patch_number, action)
+                    return
                 ref.add_comment(comment)
                 self.logger.debug(comment)
                 if isinstance(ref, TaigaIssue):
@@ -165,12 +427,14 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
                 if status:
                     ref.status = status
                 ref.update()
+                self.remember(patch_number, action)
                 self.logger.debug('ref #%s updated' % issue_id)
 
+        self.fan_out(update_ref, self.find_refs(payload))
+
     def on_comment_added(self, project, repo, payload):
         super(TaigaItemUpdateHook, self).on_comment_added(
             project, repo, payload)
-        commit_msg = payload.get('change', {}).get('commitMessage')
         subject = payload.get('change', {}).get('subject')
         patch_number = payload.get('change', {}).get('number')
         patchset = payload.get('patchSet', {}).get('number')
@@ -183,7 +447,12 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
                  for a in approvals]
         ready_for_review = (any(_test) and owner == author)
         if ready_for_review:
-            for issue_id, status in self.tracker_regex.findall(commit_msg):
+            def update_ref(issue_id, status):
+                action = 'ready-for-review:%s:%s' % (issue_id, patchset)
+                if self.already_done(patch_number, action):
+                    self.logger.debug('Ref #%s up to date, skipping'
+                                      % issue_id)
+                    return
                 # status irrelevant here
                 ref = None
                 try:
@@ -215,18 +484,25 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
                 if status:
                     ref.status = status
                     ref.update()
+                    self.remember(patch_number, action)
                     self.logger.debug("#%s set to '%s'" % (issue_id, status))
 
+            self.fan_out(update_ref, self.find_refs(payload))
+
     def on_change_merged(self, project, repo, payload):
         super(TaigaItemUpdateHook, self).on_change_merged(
             project, repo, payload)
-        commit_msg = payload.get('change', {}).get('commitMessage')
         subject = payload.get('change', {}).get('subject')
         patch_number = payload.get('change', {}).get('number')
         url = payload.get('change', {}).get('url')
         # prepare error msg
         m = 'status "%s" not found, using default status'
-        for issue_id, status in self.tracker_regex.findall(commit_msg):
+
+        def update_ref(issue_id, status):
+            action = 'merged:%s' % issue_id
+            if self.already_done(patch_number, action):
+                self.logger.debug('Ref #%s up to date, skipping' % issue_id)
+                return
             ref = None
             # remove leading '#'
             status = status[1:].lower()
@@ -275,4 +551,7 @@ class TaigaItemUpdateHook(BaseIssueTrackerHook):
                 if status:
                     ref.status = status
                 ref.update()
+                self.remember(patch_number, action)
                 self.logger.debug('ref #%s updated' % issue_id)
+
+        self.fan_out(update_ref, self.find_refs(payload))
@@ -20,6 +20,12 @@ import re
 from firehooks.hooks import base
 
 
+AUTOHOLD_REGEX = re.compile(
+    r'autohold (?P<job>.+?) on (?P<tenant>.+)'
+    r'(\s+hold for (?P<duration>\d+) (?P<unit>hour|minute))?',
+    re.I)
+
+
 class SFZuulAutoholdHook(base.GerritHook):
     """Hook used to allow authorized users to set a nodeset on hold
     automatically in case of a job failure on a given Gerrit review.
@@ -27,12 +33,13 @@ class SFZuulAutoholdHook(base.GerritHook):
     The hook is triggered by commenting on a review, following this pattern:
 
     autohold <job name> on <tenant> [hold for <duration>]"""
+
+    payload_fields = ('comment', 'change.number', 'change.id',
+                      'patchSet.number', 'author.username')
+
     def __init__(self, **config):
         super(SFZuulAutoholdHook, self).__init__(**config)
-        self.autohold_regex = re.compile(
-            'autohold (?P<job>.+?) on (?P<tenant>.+)'
-            '(\s+hold for (?P<duration>\d+) (?P<unit>hour|minute))?',
-            re.I)
+        self.autohold_regex = AUTOHOLD_REGEX
 
     def on_comment_added(self, project, repo, payload):
         super(SFZuulAutoholdHook, self).on_undefined('comment-added')(
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import collections
+import threading
+import time
+
+from six.moves.urllib.parse import parse_qsl
+from six.moves.urllib.parse import urlsplit
+
+
+class HTTPCache(object):
+    """A size-bounded cache of the responses to GET requests.
+
+    Responses carrying an ETag or a Last-Modified validator are revalidated
+    with a conditional request every time they are read, so that an
+    unchanged resource costs a 304 instead of a full body. Responses
+    without validators are served from the cache for "ttl" seconds; a ttl
+    of 0 disables caching them. At most "max_entries" responses are kept,
+    the least recently used ones being evicted first."""
+
+    def __init__(self, max_entries=1000, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params=None, headers=None):
+        params = sorted((params or {}).items())
+        headers = sorted((headers or {}).items())
+        return (url, tuple(params), tuple(headers))
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def _store(self, key, response, validators):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (response, validators, time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, url, send, headers=None, params=None, **kwargs):
+        """Returns: the response to GET url, send(headers=..., params=...,
+        **kwargs) being called to query the server when needed."""
+        key = self.key(url, params, headers)
+        entry = self._lookup(key)
+        headers = dict(headers or {})
+        if entry is not None:
+            response, validators, stored = entry
+            if not validators:
+                if time.time() - stored < self.ttl:
+                    self.hits += 1
+                    return response
+            else:
+                if 'ETag' in validators:
+                    headers['If-None-Match'] = validators['ETag']
+                if 'Last-Modified' in validators:
+                    headers['If-Modified-Since'] = validators['Last-Modified']
+        result = send(headers=headers, params=params, **kwargs)
+        if entry is not None and result.status_code == 304:
+            self.revalidated += 1
+            self._store(key, entry[0], entry[1])
+            return entry[0]
+        self.misses += 1
+        if result.status_code == 200 and\
+                'no-store' not in result.headers.get('Cache-Control', ''):
+            validators = dict((v, result.headers[v])
+                              for v in ('ETag', 'Last-Modified')
+                              if result.headers.get(v))
+            if validators or self.ttl > 0:
+                self._store(key, result, validators)
+        return result
+
+    def invalidate(self, url=None):
+        """Forget the responses to url, its parents and its children, or
+        everything if url is None."""
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+                return
+            url = url.split('?')[0].rstrip('/') + '/'
+            for key in list(self._entries):
+                cached = key[0].split('?')[0].rstrip('/') + '/'
+                if cached.startswith(url) or url.startswith(cached):
+                    del self._entries[key]
+
+    def invalidate_if(self, predicate):
+        """Forget the responses for which predicate(url, params) is true,
+        url being stripped of its query string and params holding the query
+        parameters, including those of the url."""
+        with self._lock:
+            for key in list(self._entries):
+                url = urlsplit(key[0])
+                params = dict(parse_qsl(url.query))
+                params.update(key[1])
+                if predicate(url._replace(query='').geturl(), params):
+                    del self._entries[key]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import itertools
+import json
+import logging
+import random
+import time
+
+from firehooks import decoder
+
+
+LOGGER = logging.getLogger('firehooks')
+
+# synthetic events published on a broker are prefixed with this, so that
+# consumers of the real firehose (gerrit/...) do not act upon them
+TOPIC_PREFIX = 'firehooks/loadgen/'
+
+# relative frequencies of the generated events
+DEFAULT_MIX = {'patchset-created': 4,
+               'comment-added': 5,
+               'change-merged': 1}
+
+
+class EventGenerator(object):
+    """Generates synthetic Gerrit events on "projects" projects, named after
+    "project_name", with at most "changes" changes open at any time.
+
+    The commit message of a change references a Taiga item (TG-<n>) with a
+    probability of "tracker_refs", and a comment requests an autohold on
+    "tenant" with a probability of "autohold"."""
+
+    def __init__(self, projects=10, changes=1000, mix=None, tracker_refs=0.3,
+                 autohold=0.01, project_name='loadgen-%i', tenant='local',
+                 seed=None):
+        self.projects = [project_name % i for i in range(projects)]
+        self.changes = changes
+        self.tracker_refs = tracker_refs
+        self.autohold = autohold
+        self.tenant = tenant
+        self.random = random.Random(seed)
+        mix = mix or DEFAULT_MIX
+        self.events = sorted(mix)
+        self.weights = [mix[e] for e in self.events]
+        self._numbers = itertools.count(1)
+        # change number -> change, patchset number
+        self._open = {}
+
+    def _new_change(self):
+        number = next(self._numbers)
+        owner = 'user%i' % self.random.randint(0, 99)
+        commit_msg = 'Change %i\n\nSynthetic change.\n' % number
+        if self.random.random() < self.tracker_refs:
+            commit_msg += '\nTG-%i\n' % self.random.randint(1, 1000)
+        change = {'project': self.random.choice(self.projects),
+                  'branch': 'master',
+                  'id': 'I%040x' % number,
+                  'number': number,
+                  'subject': 'Change %i' % number,
+                  'owner': {'username': owner},
+                  'url': 'https://gerrit.loadgen/%i' % number,
+                  'commitMessage': commit_msg,
+                  'status': 'NEW'}
+        self._open[number] = [change, 0]
+        return number
+
+    def _pick(self, new=False):
+        """Returns: the number of an open change, a new one if new is set
+        and there is room for it."""
+        if not self._open or (new and len(self._open) < self.changes):
+            return self._new_change()
+        return self.random.choice(list(self._open))
+
+    def _choose_event(self):
+        point = self.random.uniform(0, sum(self.weights))
+        for event, weight in zip(self.events, self.weights):
+            point -= weight
+            if point <= 0:
+                return event
+        return self.events[-1]
+
+    def event(self):
+        """Returns: the topic and payload of the next event"""
+        event = self._choose_event()
+        number = self._pick(new=(event == 'patchset-created'))
+        change, patchset = self._open[number]
+        if not patchset:
+            # comments and merges happen on changes with a patchset
+            event = 'patchset-created'
+        owner = change['owner']['username']
+        payload = {'type': event,
+                   'eventCreatedOn': time.time(),
+                   'change': change}
+        if event == 'patchset-created':
+            patchset += 1
+            self._open[number][1] = patchset
+            payload['uploader'] = {'username': owner}
+        elif event == 'comment-added':
+            author = self.random.choice([owner, 'reviewer'])
+            comment = 'Patch Set %i: Code-Review+1' % patchset
+            if self.random.random() < self.autohold:
+                comment += '\n\nautohold run-tests on %s' % self.tenant
+            payload.update({'author': {'username': author},
+                            'comment': comment,
+                            'approvals': [{'type': 'Code-Review',
+                                           'value': '1'}]})
+        elif event == 'change-merged':
+            del self._open[number]
+            change = dict(change, status='MERGED')
+            payload.update({'change': change,
+                            'submitter': {'username': 'reviewer'}})
+        payload['patchSet'] = {'number': patchset,
+                               'revision': '%040x' % (number * 1000 +
+                                                      patchset),
+                               'uploader': {'username': owner}}
+        topic = 'gerrit/%s/%s' % (change['project'], event)
+        return topic, json.dumps(payload).encode('utf-8')
+
+
+class LoadTest(object):
+    """Feeds a dispatcher with synthetic events at increasing rates, to find
+    the highest rate its hooks sustain.
+
+    Events are sent with publish(topic, payload), straight to the
+    dispatcher by default. The rate starts at "start_rate" events per
+    second and grows by "step" every "duration" seconds, up to "max_rate".
+    A rate is sustained if, at the end of its step, events wait less than
+    "max_lag" seconds before being processed and the backlog can be
+    processed in less than "max_lag" seconds at that rate."""
+
+    def __init__(self, dispatcher, generator, publish=None, start_rate=10,
+                 step=10, max_rate=1000, duration=30, max_lag=1.0):
+        if start_rate <= 0 or step <= 0:
+            raise ValueError('Rates must be positive')
+        self.dispatcher = dispatcher
+        self.generator = generator
+        self.publish = publish or self.dispatch
+        self.start_rate = start_rate
+        self.step = step
+        self.max_rate = max_rate
+        self.duration = duration
+        self.max_lag = max_lag
+        self.results = []
+
+    def dispatch(self, topic, payload):
+        self.dispatcher.dispatch(
+            decoder.Message(topic, payload, self.dispatcher.fields))
+
+    def emit(self, rate, duration):
+        """Send events at rate per second for duration seconds.
+
+        Returns: the number of events sent"""
+        start = time.time()
+        sent = 0
+        while True:
+            elapsed = time.time() - start
+            if elapsed >= duration:
+                return sent
+            due = int(elapsed * rate) + 1
+            while sent < due:
+                self.publish(*self.generator.event())
+                sent += 1
+            time.sleep(min(1.0 / rate, duration - elapsed))
+
+    def run(self):
+        """Returns: the highest sustained rate, 0 if none"""
+        sustained = 0
+        rate = self.start_rate
+        while rate <= self.max_rate:
+            sent = self.emit(rate, self.duration)
+            stats = self.dispatcher.stats()
+            ok = (stats['lag'] <= self.max_lag and
+                  stats['pending'] <= rate * self.max_lag)
+            self.results.append({'rate': rate,
+                                 'sent': sent,
+                                 'lag': stats['lag'],
+                                 'pending': stats['pending'],
+                                 'workers': stats['workers'],
+                                 'sustained': ok})
+            LOGGER.info('%g events/s: lag %.2fs, %i pending, %i worker(s)%s'
+                        % (rate, stats['lag'], stats['pending'],
+                           stats['workers'], '' if ok else ', lagging'))
+            if not ok:
+                break
+            sustained = rate
+            rate += self.step
+        return sustained
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import contextlib
+import cProfile
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from firehooks import decoder
+
+
+LOGGER = logging.getLogger('firehooks')
+
+_local = threading.local()
+# HTTP methods allowed offline
+READ_METHODS = ('GET', 'HEAD')
+_capture_seq = itertools.count()
+
+
+def record(kind, **details):
+    """Add an entry to the timeline of the message being processed by the
+    current thread, if any."""
+    timeline = getattr(_local, 'timeline', None)
+    if timeline is not None:
+        details.update({'kind': kind, 'at': time.time()})
+        timeline.append(details)
+
+
+def install_http_tracing():
+    """Record the HTTP calls made through requests in the timeline."""
+    try:
+        from requests.adapters import HTTPAdapter
+    except ImportError:
+        return
+    if getattr(HTTPAdapter.send, '_firehooks_traced', False):
+        return
+    original_send = HTTPAdapter.send
+
+    def send(self, request, **kwargs):
+        if getattr(_local, 'timeline', None) is None:
+            return original_send(self, request, **kwargs)
+        start = time.time()
+        status = None
+        try:
+            response = original_send(self, request, **kwargs)
+            status = response.status_code
+            return response
+        except Exception as e:
+            status = repr(e)
+            raise
+        finally:
+            record('http', method=request.method, url=request.url,
+                   status=status, duration=time.time() - start)
+
+    send._firehooks_traced = True
+    HTTPAdapter.send = send
+
+
+def start_profile():
+    """Returns: a new, enabled cProfile profile, or None if it cannot be
+    enabled: since python 3.12, only one profiler can be active at a time
+    in the whole process. Profiling must never prevent processing."""
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as e:
+        LOGGER.debug('Not profiling: %s' % e)
+        return None
+    return profile
+
+
+def bind(func):
+    """Returns: func, set to run in another thread (a thread pool) with the
+    timeline and the profiling of the calling thread, so that the work it
+    hands over is still traced."""
+    timeline = getattr(_local, 'timeline', None)
+    profiles = getattr(_local, 'profiles', None)
+    if timeline is None and profiles is None:
+        return func
+
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'timeline', None)
+        _local.timeline = timeline
+        try:
+            profile = start_profile() if profiles is not None else None
+            if profile is None:
+                return func(*args, **kwargs)
+            profiles.append(profile)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            _local.timeline = previous
+
+    return bound
+
+
+@contextlib.contextmanager
+def offline(enabled=True):
+    """Make the HTTP calls made through requests that could change something
+    (anything but GET and HEAD) fail, rather than reach the services a
+    replayed event would act upon, if enabled. Reads still go through, so
+    that slow reads are reproduced."""
+    if not enabled:
+        yield
+        return
+    from requests.adapters import HTTPAdapter
+    from requests.exceptions import ConnectionError
+    original_send = HTTPAdapter.send
+
+    def send(self, request, **kwargs):
+        if request.method in READ_METHODS:
+            return original_send(self, request, **kwargs)
+        LOGGER.warning('Offline: not sending %s %s' % (request.method,
+                                                       request.url))
+        raise ConnectionError('HTTP writes are disabled offline',
+                              request=request)
+
+    HTTPAdapter.send = send
+    try:
+        yield
+    finally:
+        HTTPAdapter.send = original_send
+
+
+class Profiler(object):
+    """Profiles hooks and captures the events that are slow to process.
+
+    Messages of the selected hooks ("hooks", all by default) are profiled
+    with cProfile with a probability of "sample_rate". Whenever processing
+    a message takes more than "threshold" seconds, the message, the
+    timeline of the outbound HTTP calls and the profile, if any, are saved
+    in a new subdirectory of "directory". Captures can be replayed with
+    "firehooks --replay"."""
+
+    def __init__(self, directory, threshold=10, hooks=None, sample_rate=1.0):
+        self.directory = directory
+        self.threshold = threshold
+        self.hooks = hooks
+        self.sample_rate = sample_rate
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        install_http_tracing()
+
+    def selected(self, name):
+        if self.hooks is not None and name not in self.hooks:
+            return False
+        return random.random() < self.sample_rate
+
+    def run(self, hook, name, index, msgs):
+        _local.timeline = []
+        profile = None
+        if self.selected(name):
+            profile = start_profile()
+        # profiles of the work handed over to other threads, see bind()
+        _local.profiles = [] if profile else None
+        start = time.time()
+        try:
+            hook.process_batch(msgs)
+        finally:
+            if profile:
+                profile.disable()
+            duration = time.time() - start
+            timeline = _local.timeline
+            profiles = _local.profiles
+            _local.timeline = _local.profiles = None
+            if duration >= self.threshold:
+                try:
+                    self.capture(name, index, msgs, start, duration,
+                                 timeline, profile, profiles)
+                except Exception as e:
+                    LOGGER.exception('Could not capture slow event: %s' % e)
+
+    def capture(self, name, index, msgs, start, duration, timeline,
+                profile, profiles=None):
+        event = msgs[0].topic.rsplit('/', 1)[-1]
+        path = os.path.join(self.directory, '%s-%s-%s-%i' % (
+            time.strftime('%Y%m%dT%H%M%S', time.localtime(start)),
+            name, event, next(_capture_seq)))
+        os.makedirs(path)
+        messages = []
+        for msg in msgs:
+            payload = msg.payload
+            if payload is None:
+                # dropped once decoded, see decoder.Message
+                payload = json.dumps(msg.data())
+            if isinstance(payload, bytes):
+                payload = payload.decode('utf-8')
+            messages.append({'topic': msg.topic, 'payload': payload})
+        with open(os.path.join(path, 'event.json'), 'w') as f:
+            json.dump({'hook': name,
+                       'index': index,
+                       'messages': messages,
+                       'start': start,
+                       'duration': duration}, f, indent=2)
+        with open(os.path.join(path, 'timeline.json'), 'w') as f:
+            json.dump([dict(e, at=e['at'] - start) for e in timeline], f,
+                      indent=2)
+        if profile:
+            import pstats
+            stats = pstats.Stats(profile)
+            for p in profiles or ():
+                stats.add(p)
+            stats.dump_stats(os.path.join(path, 'profile.pstats'))
+        LOGGER.warning(
+            'Hook %s took %.2fs to process %i message(s), captured in %s' % (
+                name, duration, len(msgs), path))
+        return path
+
+
+def load_capture(path):
+    """Returns: the captured event description and messages"""
+    with open(os.path.join(path, 'event.json')) as f:
+        event = json.load(f)
+    return event, [decoder.Message(m['topic'], m['payload'])
+                   for m in event['messages']]
@@ -16,10 +16,24 @@
 # under the License.
 
 
-import requests
-from requests.auth import HTTPBasicAuth
-from pysflib import sfauth
+import collections
 import logging
+import threading
+
+from firehooks.httpcache import HTTPCache
+
+
+def _not_sent(error):
+    """Returns: whether a request failed with error before reaching the
+    server: the connection timed out or was refused."""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests wraps the urllib3 errors in a MaxRetryError
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, NewConnectionError)
 
 
 class SoftwareFactory(object):
@@ -39,9 +53,23 @@ class SoftwareFactory(object):
         # Default value, will change with next release of SF
         self._apikey = "password"
         self.verify = config.get('verify', False)
+        # review comments posted on the same revision within "window"
+        # seconds are sent to gerrit as a single review
+        reviews = config.get('reviews', {})
+        self.review_window = reviews.get('window', 0)
+        self.review_retries = reviews.get('retries', 3)
+        self._reviews = collections.OrderedDict()
+        self._reviews_lock = threading.Lock()
+        # reads from managesf, revalidated or cached according to "cache"
+        self.cache = HTTPCache(**config.get('cache', {}))
 
     @property
     def apikey(self):
+        # client libraries are only imported once they are needed, to keep
+        # startup fast
+        import requests
+        from requests.auth import HTTPBasicAuth
+        from pysflib import sfauth
         # since the api key can change anytime, we need to always validate it
         resp = requests.head(self.gerrit_endpoint + "accounts/self/",
                              auth=HTTPBasicAuth(self.user, self._apikey),
@@ -61,6 +89,7 @@ class SoftwareFactory(object):
         return self._apikey
 
     def _fetch_as(self, verb, user, url_end, **kwargs):
+        import requests
         headers = {}
         url = self.managesf_endpoint + url_end
         if 'headers' in kwargs:
@@ -69,26 +98,91 @@ class SoftwareFactory(object):
         kwargs['headers'] = headers
         return getattr(requests, verb)(url, **kwargs)
 
+    def _write_as(self, verb, user, url_end, **kwargs):
+        try:
+            return self._fetch_as(verb, user, url_end, **kwargs)
+        finally:
+            self.cache.invalidate(self.managesf_endpoint + url_end)
+
     def get_as(self, user, url_end, **kwargs):
-        return self._fetch_as('get', user, url_end, **kwargs)
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers['X-Remote-User'] = user
+
+        def send(**kw):
+            return self._fetch_as('get', user, url_end, **kw)
+
+        return self.cache.get(self.managesf_endpoint + url_end, send,
+                              headers=headers, **kwargs)
 
     def put_as(self, user, url_end, **kwargs):
-        return self._fetch_as('put', user, url_end, **kwargs)
+        return self._write_as('put', user, url_end, **kwargs)
 
     def post_as(self, user, url_end, **kwargs):
-        return self._fetch_as('post', user, url_end, **kwargs)
+        return self._write_as('post', user, url_end, **kwargs)
 
     def delete_as(self, user, url_end, **kwargs):
-        return self._fetch_as('delete', user, url_end, **kwargs)
+        return self._write_as('delete', user, url_end, **kwargs)
 
     def comment_on_review(self, changeid, revision, comment):
-        reviewInput = {'message': comment}
+        if not self.review_window:
+            self._post_review(changeid, revision, [comment])
+            return
+        key = (changeid, revision)
+        with self._reviews_lock:
+            if key in self._reviews:
+                self._reviews[key].append(comment)
+                return
+            self._reviews[key] = [comment]
+        timer = threading.Timer(self.review_window, self.flush_review, key)
+        timer.daemon = True
+        timer.start()
+
+    def flush_review(self, changeid, revision):
+        with self._reviews_lock:
+            comments = self._reviews.pop((changeid, revision), None)
+        if comments:
+            self._post_review(changeid, revision, comments)
+
+    def flush_reviews(self):
+        """Send all the pending review comments right away."""
+        with self._reviews_lock:
+            pending = list(self._reviews)
+        for changeid, revision in pending:
+            self.flush_review(changeid, revision)
+
+    def _post_review(self, changeid, revision, comments, attempt=0):
+        import requests
+        from requests.auth import HTTPBasicAuth
+        reviewInput = {'message': '\n\n'.join(comments)}
         url_end = "changes/%s/revisions/%s/review" % (changeid, revision)
         self.logger.debug(self.gerrit_endpoint + url_end)
-        resp = requests.post(self.gerrit_endpoint + url_end,
-                             json=reviewInput,
-                             auth=HTTPBasicAuth(self.user, self.apikey))
-        self.logger.debug(resp.status_code)
+        try:
+            resp = requests.post(self.gerrit_endpoint + url_end,
+                                 json=reviewInput,
+                                 auth=HTTPBasicAuth(self.user, self.apikey))
+        except requests.RequestException as e:
+            if not _not_sent(e):
+                # gerrit may have applied the review already (read timeout,
+                # connection aborted...), retrying could post it twice
+                self.logger.error('Could not post %i comment(s) on %s: %s'
+                                  % (len(comments), url_end, e))
+                return
+            self.logger.debug('review on %s failed: %s' % (url_end, e))
+        else:
+            self.logger.debug(resp.status_code)
+            # client errors will not get any better by retrying
+            if resp.status_code < 500:
+                return resp
+        if attempt >= self.review_retries:
+            self.logger.error('Could not post %i comment(s) on %s' % (
+                len(comments), url_end))
+            return
+        # retry later rather than sleeping, not to hold the caller (a
+        # dispatcher worker)
+        timer = threading.Timer(2 ** attempt, self._post_review,
+                                (changeid, revision, comments, attempt + 1))
+        timer.daemon = True
+        timer.start()
 
 
 # TODO instantiate from config
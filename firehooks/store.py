@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from firehooks import decoder
+
+
+LOGGER = logging.getLogger('firehooks')
+
+
+class ChangeState(object):
+    """What is known about a change from the events seen so far."""
+
+    __slots__ = ('number', 'owner', 'patchset', 'refs', 'actions')
+
+    def __init__(self, number, owner=None, patchset=None, refs=None,
+                 actions=None):
+        self.number = number
+        self.owner = owner
+        self.patchset = patchset
+        # per reference pattern: [commit message digest, references]
+        self.refs = refs or {}
+        self.actions = set(actions or [])
+
+    def to_dict(self):
+        return {'owner': self.owner,
+                'patchset': self.patchset,
+                'refs': self.refs,
+                'actions': sorted(self.actions)}
+
+
+class ChangeStore(object):
+    """Incremental state of the changes seen on the firehose, keyed by
+    change number.
+
+    The state is kept in memory for the last "max_changes" changes, and
+    persisted in an SQLite database if "path" is set, so that it survives
+    restarts. Changes are written to the database in the background every
+    "flush_interval" seconds, and the database keeps the "max_changes"
+    most recently updated changes."""
+
+    # payload fields needed to feed the store
+    payload_fields = ('change.number', 'change.owner.username',
+                      'patchSet.number')
+
+    def __init__(self, path=None, max_changes=10000, flush_interval=5):
+        self.path = path
+        self.max_changes = max_changes
+        self.flush_interval = flush_interval
+        self._changes = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._db = None
+        # changes to write to the database, and being written
+        self._dirty = {}
+        self._flushing = {}
+        self._db_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._flusher = None
+        if path:
+            import sqlite3
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS changes '
+                             '(number INTEGER PRIMARY KEY, state TEXT, '
+                             'updated REAL)')
+            self._db.commit()
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='firehooks-store')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _load(self, number):
+        if self._db is None:
+            return None
+        state = self._dirty.get(number) or self._flushing.get(number)
+        if state is not None:
+            return state
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT state FROM changes WHERE number = ?',
+                (number, )).fetchone()
+        if row is None:
+            return None
+        return ChangeState(number, **json.loads(row[0]))
+
+    def _save(self, state):
+        if self._db is not None:
+            self._dirty[state.number] = state
+
+    def flush(self):
+        """Write the changes updated since the last flush to the database,
+        and forget the least recently updated ones beyond max_changes."""
+        if self._db is None:
+            return
+        with self._lock:
+            self._flushing, self._dirty = self._dirty, {}
+            now = time.time()
+            rows = [(n, json.dumps(state.to_dict()), now)
+                    for n, state in self._flushing.items()]
+        try:
+            if rows:
+                with self._db_lock:
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO changes VALUES (?, ?, ?)',
+                        rows)
+                    self._db.execute(
+                        'DELETE FROM changes WHERE number NOT IN '
+                        '(SELECT number FROM changes '
+                        'ORDER BY updated DESC LIMIT ?)',
+                        (self.max_changes, ))
+                    self._db.commit()
+        except Exception:
+            with self._lock:
+                # try again at the next flush
+                for n, state in self._flushing.items():
+                    self._dirty.setdefault(n, state)
+            raise
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _flush_loop(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                LOGGER.exception('Could not save the change state: %s' % e)
+
+    def close(self):
+        """Stop the background writes and write the pending changes."""
+        self._stopping.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def get(self, number, create=False):
+        with self._lock:
+            state = self._changes.pop(number, None)
+            if state is None:
+                state = self._load(number)
+            if state is None:
+                if not create:
+                    return None
+                state = ChangeState(number)
+            self._changes[number] = state
+            while len(self._changes) > self.max_changes:
+                self._changes.popitem(last=False)
+            return state
+
+    def feed(self, msg):
+        """Update the state of a change from a gerrit event."""
+        try:
+            payload = decoder.decode(msg, self.payload_fields)
+        except Exception as e:
+            LOGGER.debug('Could not decode %s: %s' % (msg.topic, e))
+            return
+        if not isinstance(payload, dict):
+            return
+        change = payload.get('change', {})
+        number = change.get('number')
+        if number is None:
+            return
+        with self._lock:
+            state = self.get(int(number), create=True)
+            owner = change.get('owner', {}).get('username')
+            patchset = payload.get('patchSet', {}).get('number')
+            if owner:
+                state.owner = owner
+            if patchset and int(patchset) > (state.patchset or 0):
+                state.patchset = int(patchset)
+            self._save(state)
+
+    def refs(self, number, commit_msg, regex):
+        """Returns: the references found by regex in the commit message of a
+        change, only parsed again when the commit message changed."""
+        if number is None:
+            return regex.findall(commit_msg or '')
+        digest = hashlib.sha1((commit_msg or '').encode('utf-8')).hexdigest()
+        with self._lock:
+            state = self.get(int(number), create=True)
+            cached = state.refs.get(regex.pattern)
+            if cached is None or cached[0] != digest:
+                refs = [list(r) if isinstance(r, tuple) else r
+                        for r in regex.findall(commit_msg or '')]
+                cached = state.refs[regex.pattern] = [digest, refs]
+                self._save(state)
+            return [tuple(r) if isinstance(r, list) else r
+                    for r in cached[1]]
+
+    def done(self, number, action):
+        """Returns: whether the action was already taken on a change."""
+        if number is None:
+            return False
+        with self._lock:
+            state = self.get(int(number))
+            return state is not None and action in state.actions
+
+    def record(self, number, action):
+        """Remember that an action was taken on a change."""
+        if number is None:
+            return
+        with self._lock:
+            state = self.get(int(number), create=True)
+            state.actions.add(action)
+            self._save(state)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import json
+
+from firehooks import cluster
+from firehooks.tests.test_hooks import FakeMessage
+
+
+def change_event(number):
+    return FakeMessage('gerrit/myproject/comment-added',
+                       json.dumps({'change': {'number': number}}))
+
+
+class TestHashRing(TestCase):
+    def test_rebalance(self):
+        ring = cluster.HashRing(['a', 'b', 'c'])
+        keys = [str(i) for i in range(300)]
+        before = dict((k, ring.get(k)) for k in keys)
+        self.assertEqual(set(['a', 'b', 'c']), set(before.values()))
+        ring.remove('b')
+        after = dict((k, ring.get(k)) for k in keys)
+        # only the keys owned by the leaving member are moved
+        for k in keys:
+            if before[k] != 'b':
+                self.assertEqual(before[k], after[k])
+            else:
+                self.assertIn(after[k], ('a', 'c'))
+        self.assertEqual(before, dict(
+            (k, cluster.HashRing(['c', 'b', 'a']).get(k)) for k in keys))
+
+
+class TestCluster(TestCase):
+    def test_exactly_one_owner(self):
+        members = [cluster.Cluster(name=n) for n in ('fh1', 'fh2', 'fh3')]
+        for m in members:
+            for other in members:
+                m.handle_membership(FakeMessage(other.member_topic,
+                                                'online'))
+        for number in range(100):
+            owners = [m for m in members if m.owns(change_event(number))]
+            self.assertEqual(1, len(owners))
+
+    def test_membership(self):
+        c = cluster.Cluster(name='fh1')
+        self.assertTrue(c.owns(change_event(12)))
+        self.assertFalse(c.handle_membership(change_event(12)))
+        self.assertTrue(c.handle_membership(
+            FakeMessage('firehooks/cluster/firehooks/fh2', 'online')))
+        self.assertEqual(set(['fh1', 'fh2']), c.ring.members)
+        self.assertTrue(c.handle_membership(
+            FakeMessage('firehooks/cluster/firehooks/fh2', '')))
+        self.assertEqual(set(['fh1']), c.ring.members)
+
+    def test_shared_mode(self):
+        c = cluster.Cluster(name='fh1', group='g1', mode='shared')
+        self.assertEqual('$share/g1/#', c.subscription)
+        self.assertTrue(c.owns(change_event(12)))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import os
+import tempfile
+import yaml
+
+from firehooks import config
+
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__),
+                              '..', '..', 'etc', 'default.yaml')
+
+
+class TestConfig(TestCase):
+    def test_default_config(self):
+        conf = config.Config(DEFAULT_CONFIG)
+        self.assertEqual(1883, conf.config['broker']['port'])
+
+    def test_validate(self):
+        conf = config.Config(DEFAULT_CONFIG).config
+        config.validate(conf)
+        del conf['software-factory']['gerrit']
+        self.assertRaises(config.ConfigError, config.validate, conf)
+        self.assertRaises(config.ConfigError, config.validate, [])
+        self.assertRaises(config.ConfigError, config.validate,
+                          {'broker': {'url': 'a', 'port': 1}})
+
+    def test_sections(self):
+        base = config.Config(DEFAULT_CONFIG).config
+        for section, value in (('scheduling', {'max_worker': 3}),
+                               ('scheduling', {'workers': 'many'}),
+                               ('scheduling', {'events': {'a': 'urgent'}}),
+                               ('state', {'paht': '/tmp/state.db'}),
+                               ('profiling', {'directory': '/tmp',
+                                              'treshold': 1}),
+                               ('cluster', {'mode': 'foo'})):
+            conf = dict(base, **{section: value})
+            self.assertRaises(config.ConfigError, config.validate, conf)
+        config.validate(dict(base, cluster={'mode': 'shared'},
+                             state={'path': '/tmp/state.db'}))
+
+    def test_invalid_hooks(self):
+        conf = config.Config(DEFAULT_CONFIG).config
+        conf['hooks']['SFDummy'] = {}
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.yaml') as f:
+            yaml.safe_dump(conf, f)
+            f.flush()
+            self.assertRaises(config.ConfigError, config.Config, f.name)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import json
+import mock
+
+from firehooks import decoder
+from firehooks import dispatcher
+from firehooks.hooks import base
+from firehooks.hooks import zuul
+from firehooks.tests.test_hooks import FakeMessage
+
+
+PAYLOAD = json.dumps({"change": {"commitMessage": "blah TG-1337",
+                                 "owner": {"username": "Johnny",
+                                           "email": "johnny@sftests.com"},
+                                 "number": 12},
+                      "patchSet": {"number": 3, "ref": "refs/changes/3"},
+                      "comment": "recheck"}).encode('utf-8')
+
+
+class TestDecoder(TestCase):
+    def test_backend(self):
+        self.assertIn(decoder.backend, decoder.BACKENDS)
+        self.assertEqual('json', decoder.set_backend('json'))
+        self.assertRaises(ValueError, decoder.set_backend, 'nojson')
+        decoder.set_backend()
+
+    def test_extract(self):
+        data = json.loads(PAYLOAD.decode('utf-8'))
+        self.assertEqual(
+            {'change': {'owner': {'username': 'Johnny'}, 'number': 12},
+             'patchSet': {'number': 3}},
+            decoder.extract(data, ('change.owner.username', 'change.number',
+                                   'patchSet.number', 'author.username',
+                                   'comment.text')))
+
+    def test_decoded_once(self):
+        msg = decoder.Message('gerrit/myproject/comment-added', PAYLOAD,
+                              set(['comment', 'change.number']))
+        data = msg.data()
+        self.assertEqual({'comment': 'recheck', 'change': {'number': 12}},
+                         data)
+        self.assertIs(data, msg.data())
+        # the raw payload is not kept once decoded
+        self.assertIsNone(msg.payload)
+        kept = decoder.Message(msg.topic, PAYLOAD, keep_payload=True)
+        kept.data()
+        self.assertEqual(PAYLOAD, kept.payload)
+        self.assertEqual(data, decoder.decode(msg, ('patchSet.number',)))
+        self.assertEqual({'patchSet': {'number': 3}}, decoder.decode(
+            FakeMessage(msg.topic, PAYLOAD), ('patchSet.number',)))
+
+
+class TestDispatcherFields(TestCase):
+    def test_fields(self):
+        d = dispatcher.Dispatcher()
+        d.register(zuul.SFZuulAutoholdHook())
+        msg = d.message(FakeMessage('gerrit/myproject/comment-added',
+                                    PAYLOAD))
+        self.assertEqual(set(zuul.SFZuulAutoholdHook.payload_fields) |
+                         set(['eventCreatedOn', 'change.id']), msg.fields)
+        self.assertNotIn('commitMessage', msg.data()['change'])
+        self.assertFalse(msg.keep_payload)
+        # raw payloads are kept for the profiler
+        self.assertTrue(dispatcher.Dispatcher(profiler=mock.Mock()).message(
+            FakeMessage(msg.topic, PAYLOAD)).keep_payload)
+        # hooks not declaring their fields get the whole payload
+        d.register(base.GerritHook())
+        self.assertIsNone(d.fields)
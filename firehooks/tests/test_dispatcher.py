@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import mock
+import threading
+
+from firehooks import dispatcher
+from firehooks.hooks import base
+from firehooks.tests.test_hooks import FakeMessage
+
+
+class RecordingHook(base.Hook):
+    def __init__(self, **config):
+        super(RecordingHook, self).__init__(**config)
+        self.processed = []
+        self.event = threading.Event()
+
+    def filter(self, msg):
+        return msg.topic.startswith('gerrit/')
+
+    def process(self, msg):
+        self.processed.append(msg.topic)
+        self.event.set()
+
+
+class TestScheduler(TestCase):
+    def drain(self, scheduler):
+        served = []
+        while scheduler.pending():
+            hook, msgs = scheduler.get()
+            served.extend((hook, msg) for msg in msgs)
+            scheduler.done(hook)
+        return served
+
+    def test_priorities(self):
+        s = dispatcher.Scheduler(events={'change-merged': 'high'})
+        slow, fast = object(), object()
+        s.register(slow, priority='low')
+        s.register(fast, priority='high')
+        # events of different changes
+        s.submit(slow, 1, 'comment-added', 'I1')
+        s.submit(slow, 2, 'change-merged', 'I2')
+        s.submit(fast, 3, 'comment-added', 'I3')
+        s.submit(slow, 4, 'comment-added', 'I4')
+        self.assertEqual([2, 3, 1, 4],
+                         [msg for hook, msg in self.drain(s)])
+
+    def test_change_order(self):
+        s = dispatcher.Scheduler(events={'change-merged': 'high'})
+        hook = object()
+        s.register(hook, priority='low')
+        s.submit(hook, 1, 'comment-added', 'I41')
+        s.submit(hook, 2, 'comment-added', 'I42')
+        s.submit(hook, 3, 'patchset-created', 'I42')
+        s.submit(hook, 4, 'change-merged', 'I42')
+        s.submit(hook, 5, 'comment-added', 'I42')
+        # the merge goes first, along with the earlier events of its change
+        self.assertEqual([2, 3, 4, 1, 5],
+                         [msg for hook, msg in self.drain(s)])
+        self.assertEqual([{}, {}, {}], s._keys[hook])
+
+    def test_weighted_fairness(self):
+        s = dispatcher.Scheduler()
+        noisy, quiet = object(), object()
+        s.register(noisy, weight=1)
+        s.register(quiet, weight=2)
+        for i in range(30):
+            s.submit(noisy, i)
+        for i in range(10):
+            s.submit(quiet, i)
+        served = [hook for hook, msg in self.drain(s)][:15]
+        # the quiet hook gets twice the share of the noisy one
+        self.assertEqual(10, served.count(quiet))
+        self.assertEqual(5, served.count(noisy))
+
+    def test_one_message_at_a_time(self):
+        s = dispatcher.Scheduler()
+        a, b = object(), object()
+        s.register(a)
+        s.register(b)
+        s.submit(a, 1)
+        s.submit(a, 2)
+        s.submit(b, 3)
+        first = s.get()
+        second = s.get()
+        self.assertEqual((a, [1]), first)
+        self.assertEqual((b, [3]), second)
+        s.done(a)
+        self.assertEqual((a, [2]), s.get())
+
+    def test_invalid_priority(self):
+        s = dispatcher.Scheduler()
+        self.assertRaises(ValueError, s.register, object(), 'urgent')
+        self.assertRaises(ValueError, dispatcher.Scheduler,
+                          {'change-merged': 'urgent'})
+
+    def test_batches(self):
+        s = dispatcher.Scheduler(events={'change-merged': 'high'})
+        batching, other = object(), object()
+        s.register(batching, batch_size=3, batch_latency=60)
+        s.register(other)
+        s.submit(batching, 1, 'comment-added')
+        s.submit(batching, 2, 'comment-added')
+        s.submit(other, 3, 'comment-added')
+        s.submit(batching, 4, 'change-merged')
+        s.submit(batching, 5, 'comment-added')
+        # the batch is ordered as received, whatever the priorities
+        self.assertEqual((batching, [1, 2, 4]), s.get())
+        self.assertEqual((other, [3]), s.get())
+
+    def test_close(self):
+        s = dispatcher.Scheduler()
+        hook = object()
+        s.register(hook)
+        s.submit(hook, 1)
+        s.submit(hook, 2)
+        s.close()
+        # queued work is still served
+        self.assertEqual((hook, [1]), s.get())
+        s.done(hook)
+        self.assertEqual({hook: 1}, s.clear())
+        self.assertIsNone(s.get())
+
+    def test_batch_latency(self):
+        s = dispatcher.Scheduler()
+        hook = object()
+        s.register(hook, batch_size=10, batch_latency=0.01)
+        s.submit(hook, 1)
+        s.submit(hook, 2)
+        self.assertEqual((hook, [1, 2]), s.get())
+
+
+class TestDispatcher(TestCase):
+    def test_dispatch(self):
+        d = dispatcher.Dispatcher(workers=2)
+        hook = RecordingHook(priority='high')
+        d.register(hook)
+        d.start()
+        d.dispatch(FakeMessage('unrelated/topic', '{}'))
+        d.dispatch(FakeMessage('gerrit/myproject/change-merged', '{}'))
+        self.assertTrue(hook.event.wait(5))
+        d.stop()
+        self.assertEqual(['gerrit/myproject/change-merged'], hook.processed)
+
+    def test_stop(self):
+
+        class BlockedHook(RecordingHook):
+            def process(self, msg):
+                super(BlockedHook, self).process(msg)
+                release.wait(5)
+
+        release = threading.Event()
+        d = dispatcher.Dispatcher(workers=2, drain_timeout=0.5)
+        hook = BlockedHook()
+        other = RecordingHook()
+        d.register(hook)
+        d.register(other)
+        for i in range(3):
+            d.dispatch(FakeMessage('gerrit/myproject/%i' % i, '{}'))
+        d.start()
+        self.assertTrue(hook.event.wait(5))
+        with mock.patch.object(dispatcher.LOGGER, 'warning') as warning:
+            d.stop()
+        release.set()
+        # the other hook got its messages, the blocked one could not
+        self.assertEqual(3, len(other.processed))
+        warning.assert_called_once_with(
+            'Stopping: dropped 2 queued message(s) of hook BlockedHook')
+
+    def test_store_feed(self):
+        store = mock.Mock(payload_fields=())
+        d = dispatcher.Dispatcher(store=store)
+        msg = FakeMessage('gerrit/myproject/change-merged', '{}')
+        d.dispatch(msg)
+        # no hook is interested in the message
+        self.assertFalse(store.feed.called)
+        d.register(RecordingHook())
+        d.dispatch(msg)
+        self.assertEqual(1, store.feed.call_count)
+
+    def test_dispatch_batches(self):
+
+        class BatchHook(RecordingHook):
+            batch_size = 3
+
+            def process_batch(self, msgs):
+                self.processed.append([m.topic for m in msgs])
+                self.event.set()
+
+        d = dispatcher.Dispatcher()
+        hook = BatchHook(batch_latency=60)
+        d.register(hook)
+        for i in range(3):
+            d.dispatch(FakeMessage('gerrit/myproject/%i' % i, '{}'))
+        d.start()
+        self.assertTrue(hook.event.wait(5))
+        d.stop()
+        self.assertEqual([['gerrit/myproject/0', 'gerrit/myproject/1',
+                           'gerrit/myproject/2']], hook.processed)
+
+    def test_change_order(self):
+        d = dispatcher.Dispatcher(events={'change-merged': 'high'})
+        hook = RecordingHook()
+        d.register(hook)
+        for event in ('comment-added', 'change-merged'):
+            d.dispatch(FakeMessage('gerrit/myproject/' + event,
+                                   '{"change": {"number": 42}}'))
+        d.start()
+        while len(hook.processed) < 2:
+            self.assertTrue(hook.event.wait(5))
+            hook.event.clear()
+        d.stop()
+        self.assertEqual(['gerrit/myproject/comment-added',
+                          'gerrit/myproject/change-merged'], hook.processed)
+
+
+class TestLag(TestCase):
+    def test_lag_stats(self):
+        stats = dispatcher.LagStats(alpha=0.5)
+        stats.observe('SFZuul', 2, 4)
+        stats.observe('SFZuul', 4, 6)
+        snapshot = stats.snapshot()['hooks']['SFZuul']
+        self.assertEqual(3, snapshot['dequeue_lag'])
+        self.assertEqual(5, snapshot['completion_lag'])
+        self.assertEqual(6, snapshot['max_completion_lag'])
+        self.assertEqual(2, snapshot['processed'])
+
+    def test_created_on(self):
+        msg = FakeMessage('gerrit/myproject/change-merged',
+                          '{"eventCreatedOn": 1500000000}')
+        self.assertEqual(1500000000, dispatcher.Dispatcher.created_on(msg))
+
+    def test_completion_lag(self):
+        d = dispatcher.Dispatcher()
+        hook = RecordingHook()
+        d.register(hook, 'SFRecording', 0)
+        d.dispatch(FakeMessage('gerrit/myproject/change-merged',
+                               '{"eventCreatedOn": 1500000000}'))
+        d.start()
+        self.assertTrue(hook.event.wait(5))
+        d.stop()
+        stats = d.stats()['hooks']['SFRecording[0]']
+        self.assertEqual(1, stats['processed'])
+        self.assertGreater(stats['completion_lag'], 1000)
+
+    def test_resize(self):
+        d = dispatcher.Dispatcher(workers=1, max_workers=3, target_lag=10,
+                                  scale_interval=60)
+        hooks = [RecordingHook() for i in range(3)]
+        for hook in hooks:
+            d.register(hook)
+        d.start()
+        try:
+            d.lag.dequeue_lag = 30
+            with mock.patch.object(d.scheduler, 'pending', return_value=5):
+                d.resize()
+                d.resize()
+                d.resize()
+            self.assertEqual(3, d.pool_size)
+            d.lag.dequeue_lag = 1
+            d.resize()
+            self.assertEqual(2, d.pool_size)
+            d.resize()
+            d.resize()
+            self.assertEqual(1, d.pool_size)
+        finally:
+            d.stop()
+
+    def test_resize_busy_workers(self):
+        # the workers are stuck on long batches: the average dequeue lag
+        # is not updated, but events are waiting
+        d = dispatcher.Dispatcher(workers=1, max_workers=2, target_lag=10,
+                                  scale_interval=60)
+        for i in range(2):
+            d.register(RecordingHook())
+        d.start()
+        try:
+            scheduler = d.scheduler
+            with mock.patch.object(scheduler, 'oldest', return_value=30):
+                with mock.patch.object(scheduler, 'pending', return_value=5):
+                    self.assertEqual(30, d.stats()['lag'])
+                    d.resize()
+            self.assertEqual(2, d.pool_size)
+        finally:
+            d.stop()
+
+    def test_oldest_pending(self):
+        s = dispatcher.Scheduler()
+        hook = RecordingHook()
+        s.register(hook)
+        self.assertEqual(0, s.oldest())
+        with mock.patch('time.time', return_value=1000):
+            s.submit(hook, 'a')
+        with mock.patch('time.time', return_value=1005):
+            s.submit(hook, 'b')
+            self.assertEqual(5, s.oldest())
+            s.get()
+            self.assertEqual(0, s.oldest())
+            s.done(hook)
+            s.get()
+            self.assertEqual(0, s.oldest())
+
+    def test_check_pool(self):
+        d = dispatcher.Dispatcher(workers=2, max_workers=8)
+        d.register(RecordingHook())
+        d.register(RecordingHook())
+        with mock.patch.object(dispatcher.LOGGER, 'warning') as warning:
+            d.check_pool()
+        self.assertEqual(2, warning.call_count)
+        for i in range(6):
+            d.register(RecordingHook())
+        with mock.patch.object(dispatcher.LOGGER, 'warning') as warning:
+            d.check_pool()
+        self.assertFalse(warning.called)
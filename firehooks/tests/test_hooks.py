@@ -24,6 +24,7 @@ import mock
 from firehooks.hooks import base
 from firehooks.hooks import trackers
 from firehooks.hooks import zuul
+from firehooks.httpcache import HTTPCache
 
 
 class FakeMessage:
@@ -33,9 +34,10 @@ class FakeMessage:
 
 
 class FakeResponse:
-    def __init__(self, status_code, text=None):
+    def __init__(self, status_code, text=None, headers=None):
         self.status_code = status_code
         self.text = text or ''
+        self.headers = headers or {}
 
 
 class TestBaseHook(TestCase):
@@ -56,6 +58,24 @@ class TestBaseHook(TestCase):
         self.assertEqual(17, dummy.x)
         dummy(4)
         self.assertEqual(4, dummy.x)
+        dummy.process_batch([5, 6])
+        self.assertEqual(6, dummy.x)
+
+    def test_batch_failure(self):
+
+        class FailingHook(base.Hook):
+            def filter(self, msg):
+                return True
+
+            def process(self, msg):
+                if msg == 1:
+                    raise Exception('Taiga is down')
+                self.processed.append(msg)
+
+        hook = FailingHook()
+        hook.processed = []
+        hook.process_batch([1, 2, 3])
+        self.assertEqual([2, 3], hook.processed)
 
 
 class TestGerritHook(TestCase):
@@ -137,6 +157,9 @@ class TestIssueTrackerHooks(TestCase):
 class TestTaigaHook(TestCase):
     # This is minimal testing, making sure the issues are checked on Taiga.
 
+    def setUp(self):
+        trackers._CLIENTS.clear()
+
     def test_patchset_created(self):
         with mock.patch('firehooks.hooks.trackers.TaigaAPI'):
             T = trackers.TaigaItemUpdateHook(auth={'username': 'a',
@@ -230,6 +253,133 @@ class TestTaigaHook(TestCase):
                 T(msg)
                 T.project.get_userstory_by_ref.assert_called_with("1337")
 
+    def test_fan_out(self):
+        with mock.patch('firehooks.hooks.trackers.TaigaAPI'):
+            T = trackers.TaigaItemUpdateHook(auth={'username': 'a',
+                                                   'password': 'b'},
+                                             project='myproject',
+                                             taiga_project='d')
+            msg = FakeMessage(
+                topic='gerrit/myproject/change-merged',
+                payload=json.dumps(
+                    {"change": {"commitMessage": "TG-1 TG-2\nTG-3 TG-1",
+                                "subject": "a_cool_change",
+                                "owner": {"username": "Johnny"},
+                                "number": 12,
+                                "url": "http://some.url"}}
+                )
+            )
+            refs = {'1': mock.MagicMock(), '3': mock.MagicMock()}
+
+            def find_by_ref(ref):
+                if ref == '2':
+                    raise Exception('Taiga is down')
+                return refs[ref]
+
+            with mock.patch.object(T, "find_by_ref") as find:
+                find.side_effect = find_by_ref
+                T(msg)
+                self.assertEqual(['1', '2', '3'],
+                                 sorted(c[0][0] for c in find.call_args_list))
+            # the failure on TG-2 does not prevent the other updates
+            for ref in refs.values():
+                ref.add_comment.assert_called_once_with(
+                    'patch [#12: a_cool_change](http://some.url) was merged.')
+                ref.update.assert_called_once_with()
+
+    def test_fan_out_status(self):
+        with mock.patch('firehooks.hooks.trackers.TaigaAPI'):
+            T = trackers.TaigaItemUpdateHook(auth={'username': 'a',
+                                                   'password': 'b'},
+                                             project='myproject',
+                                             taiga_project='d')
+        update_ref = mock.Mock()
+        T.fan_out(update_ref, [('12', ''), ('5', ''), ('12', '#closed'),
+                               ('12', '#new')])
+        self.assertEqual([mock.call('12', '#closed'), mock.call('5', '')],
+                         sorted(update_ref.call_args_list))
+        self.assertIs(trackers.get_pool(), trackers.get_pool())
+
+
+class TestTaigaClient(TestCase):
+    def setUp(self):
+        trackers._CLIENTS.clear()
+
+    def test_shared_client(self):
+        with mock.patch('firehooks.hooks.trackers.TaigaAPI') as API:
+            hooks = [trackers.TaigaItemUpdateHook(auth={'username': 'a',
+                                                        'password': 'b'},
+                                                  project='myproject',
+                                                  taiga_project=p)
+                     for p in ('d', 'e')]
+            other = trackers.TaigaItemUpdateHook(auth={'username': 'c',
+                                                       'password': 'b'},
+                                                 project='myproject',
+                                                 taiga_project='d')
+            self.assertIs(hooks[0].client, hooks[1].client)
+            self.assertIsNot(hooks[0].client, other.client)
+            self.assertEqual(2, API.return_value.auth.call_count)
+
+    def test_token_refresh(self):
+        client = mock.MagicMock(max_concurrency=2)
+        client.login.return_value = 'fresh'
+        client.cache = HTTPCache()
+        rm = trackers.SharedRequestMaker(client, '/api/v1',
+                                         'https://taiga', 'expired')
+        with mock.patch.object(rm.session, 'request') as request:
+            request.side_effect = [FakeResponse(401), FakeResponse(200)]
+            self.assertEqual(200, rm.get('/projects').status_code)
+            self.assertEqual('fresh', rm.token)
+            self.assertEqual(
+                'Bearer fresh',
+                request.call_args[1]['headers']['Authorization'])
+
+    def test_cache(self):
+        client = mock.MagicMock(max_concurrency=2)
+        client.cache = HTTPCache()
+        rm = trackers.SharedRequestMaker(client, '/api/v1',
+                                         'https://taiga', 'token')
+        with mock.patch.object(rm.session, 'request') as request:
+            request.side_effect = [
+                FakeResponse(200, 'old', {'ETag': '"1"'}),
+                FakeResponse(304),
+                FakeResponse(200),
+                FakeResponse(200, 'new', {'ETag': '"2"'})]
+            self.assertEqual('old', rm.get('/issues/1').text)
+            self.assertEqual('old', rm.get('/issues/1').text)
+            headers = request.call_args[1]['headers']
+            self.assertEqual('"1"', headers['If-None-Match'])
+            self.assertNotIn('paginate', headers)
+            rm.patch('/issues/1', {'status': 2})
+            self.assertEqual('new', rm.get('/issues/1').text)
+            self.assertNotIn('If-None-Match',
+                             request.call_args[1]['headers'])
+
+    def test_cache_invalidation(self):
+        client = mock.MagicMock(max_concurrency=2)
+        client.cache = HTTPCache(ttl=60)
+        rm = trackers.SharedRequestMaker(client, '/api/v1',
+                                         'https://taiga', 'token')
+        written = FakeResponse(200)
+        written.json = lambda: {'id': 42, 'project': 3}
+        reads = ['/tasks/42', '/tasks/4', '/history/task/42',
+                 '/history/task/4', '/tasks/by_ref?ref=7&project=3',
+                 '/tasks/by_ref?ref=7&project=5',
+                 '/issues/by_ref?ref=7&project=3']
+        with mock.patch.object(rm.session, 'request') as request:
+            request.side_effect = [FakeResponse(200) for r in reads] + [
+                written]
+            for uri in reads:
+                rm.get(uri)
+            rm.patch('/tasks/{id}', {'status': 2}, id=42)
+        # only the written task, its history and the lookups of tasks in
+        # its project are forgotten
+        self.assertEqual(
+            ['/tasks/4', '/history/task/4', '/tasks/by_ref?ref=7&project=5',
+             '/issues/by_ref?ref=7&project=3'],
+            [k[0][len('https://taiga/api/v1'):]
+             for k in client.cache._entries])
+
 
 class TestZuulHook(TestCase):
     def test_autohold(self):
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import mock
+import time
+
+from firehooks.httpcache import HTTPCache
+from firehooks.tests.test_hooks import FakeResponse
+
+
+class TestHTTPCache(TestCase):
+    def test_revalidation(self):
+        cache = HTTPCache()
+        send = mock.Mock(side_effect=[
+            FakeResponse(200, 'a', {'Last-Modified': 'yesterday'}),
+            FakeResponse(304)])
+        self.assertEqual('a', cache.get('http://x/a', send).text)
+        self.assertEqual('a', cache.get('http://x/a', send).text)
+        send.assert_called_with(headers={'If-Modified-Since': 'yesterday'},
+                                params=None)
+        self.assertEqual((1, 1), (cache.misses, cache.revalidated))
+
+    def test_ttl(self):
+        send = mock.Mock(return_value=FakeResponse(200, 'a'))
+        cache = HTTPCache()
+        cache.get('http://x/a', send)
+        cache.get('http://x/a', send)
+        self.assertEqual(2, send.call_count)
+        cache = HTTPCache(ttl=60)
+        send.reset_mock()
+        cache.get('http://x/a', send)
+        cache.get('http://x/a', send)
+        self.assertEqual(1, send.call_count)
+        with mock.patch('time.time', return_value=time.time() + 61):
+            cache.get('http://x/a', send)
+        self.assertEqual(2, send.call_count)
+
+    def test_keys(self):
+        cache = HTTPCache(ttl=60)
+        send = mock.Mock(return_value=FakeResponse(200))
+        cache.get('http://x/a', send, headers={'X-Remote-User': 'a'})
+        cache.get('http://x/a', send, headers={'X-Remote-User': 'b'})
+        cache.get('http://x/a', send, params={'page': 2})
+        self.assertEqual(3, send.call_count)
+
+    def test_no_store(self):
+        cache = HTTPCache(ttl=60)
+        send = mock.Mock(return_value=FakeResponse(
+            200, headers={'Cache-Control': 'no-store'}))
+        cache.get('http://x/a', send)
+        cache.get('http://x/a', send)
+        self.assertEqual(2, send.call_count)
+
+    def test_eviction(self):
+        cache = HTTPCache(max_entries=2, ttl=60)
+        send = mock.Mock(return_value=FakeResponse(200))
+        for url in ('http://x/a', 'http://x/b', 'http://x/a', 'http://x/c'):
+            cache.get(url, send)
+        self.assertEqual(3, send.call_count)
+        cache.get('http://x/a', send)
+        self.assertEqual(3, send.call_count)
+        cache.get('http://x/b', send)
+        self.assertEqual(4, send.call_count)
+
+    def test_invalidate(self):
+        cache = HTTPCache(ttl=60)
+        send = mock.Mock(return_value=FakeResponse(200))
+        for url in ('http://x/project/', 'http://x/project/p1',
+                    'http://x/project/p2', 'http://x/user/'):
+            cache.get(url, send)
+        cache.invalidate('http://x/project/p1')
+        self.assertEqual(['http://x/project/p2', 'http://x/user/'],
+                         [k[0] for k in cache._entries])
+        cache.invalidate()
+        self.assertEqual(0, len(cache._entries))
+
+    def test_invalidate_if(self):
+        cache = HTTPCache(ttl=60)
+        send = mock.Mock(return_value=FakeResponse(200))
+        cache.get('http://x/items/by_ref?ref=1&project=3', send)
+        cache.get('http://x/items/by_ref', send, params={'project': '3'})
+        cache.get('http://x/items/by_ref?ref=1&project=4', send)
+        cache.invalidate_if(lambda url, params: url == 'http://x/items/by_ref'
+                            and params.get('project') == '3')
+        self.assertEqual(['http://x/items/by_ref?ref=1&project=4'],
+                         [k[0] for k in cache._entries])
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import json
+import subprocess
+import sys
+
+
+HEAVY = ('paho', 'pysflib', 'requests', 'stevedore', 'taiga')
+
+
+def imported_after(statement):
+    code = ('import json, sys; %s; '
+            'print(json.dumps(sorted(sys.modules)))' % statement)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return set(m.split('.')[0] for m in json.loads(out.decode('utf-8')))
+
+
+class TestLazyImports(TestCase):
+    def test_daemon_imports(self):
+        loaded = imported_after('import firehooks.firehooks')
+        self.assertEqual([], [m for m in HEAVY if m in loaded])
+
+    def test_zuul_hook_imports(self):
+        loaded = imported_after('import firehooks.hooks.zuul')
+        self.assertEqual([], [m for m in HEAVY if m in loaded])
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import argparse
+import json
+import mock
+
+from firehooks import dispatcher
+from firehooks import firehooks
+from firehooks import loadgen
+from firehooks.hooks import trackers
+from firehooks.hooks import zuul
+from firehooks.tests.test_dispatcher import RecordingHook
+from firehooks.tests.test_hooks import FakeMessage
+
+
+class TestEventGenerator(TestCase):
+    def events(self, n, **kwargs):
+        generator = loadgen.EventGenerator(seed=42, **kwargs)
+        return [generator.event() for i in range(n)]
+
+    def test_events(self):
+        events = self.events(2000, projects=3, changes=20)
+        kinds = {}
+        open_changes = set()
+        for topic, payload in events:
+            payload = json.loads(payload.decode('utf-8'))
+            _, project, event = topic.split('/')
+            self.assertEqual(event, payload['type'])
+            self.assertIn(project, ('loadgen-0', 'loadgen-1', 'loadgen-2'))
+            self.assertIn('eventCreatedOn', payload)
+            number = payload['change']['number']
+            if event == 'change-merged':
+                open_changes.remove(number)
+            else:
+                open_changes.add(number)
+            self.assertLessEqual(len(open_changes), 20)
+            kinds[event] = kinds.get(event, 0) + 1
+        self.assertEqual(set(loadgen.DEFAULT_MIX), set(kinds))
+        self.assertLess(kinds['change-merged'], kinds['comment-added'])
+
+    def test_references(self):
+        events = self.events(50, tracker_refs=1, autohold=1)
+        comments = [json.loads(p.decode('utf-8'))['comment']
+                    for t, p in events if t.endswith('comment-added')]
+        self.assertTrue(comments)
+        self.assertTrue(all(zuul.AUTOHOLD_REGEX.search(c)
+                            for c in comments))
+        msg = json.loads(events[0][1].decode('utf-8'))
+        self.assertTrue(
+            trackers.TAIGA_REGEX.findall(msg['change']['commitMessage']))
+
+    def test_seed(self):
+        self.assertEqual([t for t, p in self.events(100)],
+                         [t for t, p in self.events(100)])
+
+
+class TestLoadTest(TestCase):
+    def test_dispatch(self):
+        d = dispatcher.Dispatcher()
+        hook = RecordingHook()
+        d.register(hook)
+        test = loadgen.LoadTest(d, loadgen.EventGenerator(seed=1))
+        sent = test.emit(200, 0.1)
+        self.assertTrue(0 < sent <= 20)
+        self.assertEqual(sent, d.scheduler.pending())
+
+    def test_highest_sustained_rate(self):
+        d = mock.Mock()
+        d.stats.side_effect = [
+            {'lag': 0.1, 'pending': 0, 'workers': 1},
+            {'lag': 0.5, 'pending': 10, 'workers': 1},
+            {'lag': 3.0, 'pending': 100, 'workers': 1}]
+        publish = mock.Mock()
+        test = loadgen.LoadTest(d, loadgen.EventGenerator(), publish,
+                                start_rate=100, step=100, duration=0.05)
+        self.assertEqual(200, test.run())
+        self.assertEqual([True, True, False],
+                         [r['sustained'] for r in test.results])
+        self.assertTrue(publish.called)
+        self.assertFalse(d.dispatch.called)
+
+    def test_via_broker(self):
+        args = argparse.Namespace(projects=1, changes=10, project_name='p%i',
+                                  seed=1, via_broker=True, broker='localhost',
+                                  port=1883, rate=100, rate_step=100,
+                                  max_rate=100, step_duration=0.02,
+                                  max_lag=1.0)
+        d = dispatcher.Dispatcher()
+        hook = RecordingHook()
+        d.register(hook)
+        with mock.patch('paho.mqtt.client.Client') as Client:
+            client = Client.return_value
+            firehooks.run_loadgen(args, d)
+        # never the configured broker, never the real firehose topics
+        client.connect.assert_called_once_with('localhost', 1883, 60)
+        client.subscribe.assert_called_once_with(
+            'firehooks/loadgen/gerrit/#')
+        topic, payload = client.publish.call_args[0]
+        self.assertTrue(topic.startswith('firehooks/loadgen/gerrit/p0/'))
+        # received events are dispatched without the prefix
+        client.on_message(client, None, FakeMessage(topic, payload))
+        self.assertEqual(topic[len('firehooks/loadgen/'):],
+                         d.scheduler.get(timeout=1)[1][0].topic)
+
+    def test_live_required(self):
+        with mock.patch('sys.argv', ['firehooks', '-c', 'conf.yaml',
+                                     'loadgen']):
+            with mock.patch('firehooks.firehooks.run_loadgen') as run:
+                self.assertRaises(SystemExit, firehooks.main)
+        self.assertFalse(run.called)
+
+    def test_no_state_database(self):
+        conf = mock.Mock(config={'software-factory': {},
+                                 'state': {'path': '/var/lib/state.db'},
+                                 'profiling': {'directory': '/tmp'}})
+        patches = [mock.patch('sys.argv', ['firehooks', '-c', 'conf.yaml',
+                                           '--live', 'loadgen']),
+                   mock.patch('signal.signal'),
+                   mock.patch('firehooks.config.Config', return_value=conf),
+                   mock.patch('firehooks.firehooks.SoftwareFactory')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # main() sets the logging up
+        handlers = list(firehooks.LOGGER.handlers)
+        self.addCleanup(setattr, firehooks.LOGGER, 'handlers', handlers)
+        self.addCleanup(firehooks.LOGGER.setLevel, firehooks.LOGGER.level)
+        with mock.patch('firehooks.firehooks.ChangeStore') as Store:
+            with mock.patch('firehooks.firehooks.Dispatcher') as Dispatcher:
+                with mock.patch('firehooks.firehooks.run_loadgen') as run:
+                    firehooks.main()
+        Store.assert_called_once_with()
+        self.assertIsNone(Dispatcher.call_args[1]['profiler'])
+        self.assertTrue(run.called)
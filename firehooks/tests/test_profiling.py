@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import json
+import mock
+import os
+import pstats
+import shutil
+import tempfile
+
+from firehooks import decoder
+from firehooks import profiling
+from firehooks.tests.test_dispatcher import RecordingHook
+
+
+class TracingHook(RecordingHook):
+    def process(self, msg):
+        profiling.record('http', method='GET', url='http://taiga')
+        super(TracingHook, self).process(msg)
+
+
+class PoolHook(RecordingHook):
+    def process(self, msg):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(2)
+        try:
+            pool.map(profiling.bind(self.call), ['http://taiga/1',
+                                                 'http://taiga/2'])
+        finally:
+            pool.close()
+        super(PoolHook, self).process(msg)
+
+    def call(self, url):
+        profiling.record('http', method='GET', url=url)
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.msg = decoder.Message('gerrit/myproject/change-merged',
+                                   b'{"change": {"number": 12}}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fast_event(self):
+        p = profiling.Profiler(self.directory, threshold=60)
+        hook = TracingHook()
+        p.run(hook, 'SFTracing', 0, [self.msg])
+        self.assertEqual([self.msg.topic], hook.processed)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_capture_and_replay(self):
+        p = profiling.Profiler(self.directory, threshold=0,
+                               hooks=['SFTracing'])
+        p.run(TracingHook(), 'SFTracing', 3, [self.msg])
+        captures = os.listdir(self.directory)
+        self.assertEqual(1, len(captures))
+        capture = os.path.join(self.directory, captures[0])
+        self.assertEqual(['event.json', 'profile.pstats', 'timeline.json'],
+                         sorted(os.listdir(capture)))
+        with open(os.path.join(capture, 'timeline.json')) as f:
+            timeline = json.load(f)
+        self.assertEqual('http://taiga', timeline[0]['url'])
+        event, msgs = profiling.load_capture(capture)
+        msg = msgs[0]
+        self.assertEqual(('SFTracing', 3), (event['hook'], event['index']))
+        self.assertEqual(self.msg.topic, msg.topic)
+        self.assertEqual({'change': {'number': 12}}, json.loads(msg.payload))
+
+    def test_thread_pool(self):
+        p = profiling.Profiler(self.directory, threshold=0)
+        p.run(PoolHook(), 'SFPool', 0, [self.msg])
+        capture = os.path.join(self.directory,
+                               os.listdir(self.directory)[0])
+        with open(os.path.join(capture, 'timeline.json')) as f:
+            timeline = json.load(f)
+        self.assertEqual(['http://taiga/1', 'http://taiga/2'],
+                         sorted(e['url'] for e in timeline))
+        stats = pstats.Stats(os.path.join(capture, 'profile.pstats'))
+        # the work done in the pool is profiled too
+        self.assertTrue([f for f in stats.stats if f[2] == 'call'])
+
+    def test_profiler_busy(self):
+        # python 3.12+ only allows one active profiler at a time
+        p = profiling.Profiler(self.directory, threshold=0)
+        hook = PoolHook()
+        with mock.patch('cProfile.Profile.enable') as enable:
+            enable.side_effect = ValueError(
+                'Another profiling tool is already active')
+            p.run(hook, 'SFPool', 0, [self.msg])
+        # processed anyway, and captured without a profile
+        self.assertEqual([self.msg.topic], hook.processed)
+        capture = os.path.join(self.directory,
+                               os.listdir(self.directory)[0])
+        self.assertEqual(['event.json', 'timeline.json'],
+                         sorted(os.listdir(capture)))
+        with open(os.path.join(capture, 'timeline.json')) as f:
+            self.assertEqual(2, len(json.load(f)))
+
+    def test_unselected_hook(self):
+        p = profiling.Profiler(self.directory, threshold=0,
+                               hooks=['SFOther'])
+        p.run(TracingHook(), 'SFTracing', 0, [self.msg])
+        capture = os.path.join(self.directory,
+                               os.listdir(self.directory)[0])
+        # slow events are captured, but not profiled
+        self.assertEqual(['event.json', 'timeline.json'],
+                         sorted(os.listdir(capture)))
+
+    def test_offline(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        send = HTTPAdapter.send
+        with mock.patch.object(HTTPAdapter, 'send') as real_send:
+            # reads reach the (mocked) network
+            real_send.side_effect = RuntimeError('sent')
+            with profiling.offline():
+                self.assertRaises(RuntimeError, requests.get,
+                                  'http://taiga/api/v1/issues')
+                self.assertEqual(1, real_send.call_count)
+                self.assertRaises(requests.ConnectionError, requests.post,
+                                  'http://taiga/api/v1/issues')
+                self.assertEqual(1, real_send.call_count)
+            self.assertIs(real_send, HTTPAdapter.send)
+        self.assertIs(send, HTTPAdapter.send)
+        with profiling.offline(False):
+            self.assertIs(send, HTTPAdapter.send)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import mock
+
+from firehooks.softwarefactory import SoftwareFactory
+from firehooks.tests.test_hooks import FakeResponse
+
+
+def get_SF(**config):
+    config.update({'auth': {'user': 'SF_SERVICE_USER',
+                            'password': 'password'},
+                   'url': 'https://sftests.com',
+                   'managesf': 'http://managesf.sftests.com:20001',
+                   'gerrit': 'http://managesf.sftests.com:8000/r/a/'})
+    return SoftwareFactory(**config)
+
+
+@mock.patch.object(SoftwareFactory, 'apikey', 'key')
+class TestReviews(TestCase):
+    url = ('http://managesf.sftests.com:8000/r/a/'
+           'changes/I12345/revisions/3/review')
+
+    def test_no_batching(self):
+        SF = get_SF()
+        with mock.patch('requests.post') as post:
+            post.return_value = FakeResponse(200)
+            SF.comment_on_review('I12345', 3, 'Hello')
+            post.assert_called_once_with(self.url,
+                                         json={'message': 'Hello'},
+                                         auth=mock.ANY)
+
+    def test_batching(self):
+        SF = get_SF(reviews={'window': 60})
+        with mock.patch('requests.post') as post:
+            post.return_value = FakeResponse(200)
+            SF.comment_on_review('I12345', 3, 'Hello')
+            SF.comment_on_review('I12345', 3, 'World')
+            SF.comment_on_review('I12345', 4, 'Other revision')
+            self.assertFalse(post.called)
+            SF.flush_reviews()
+            self.assertEqual(2, post.call_count)
+            post.assert_any_call(self.url,
+                                 json={'message': 'Hello\n\nWorld'},
+                                 auth=mock.ANY)
+
+    def test_retries(self):
+        SF = get_SF(reviews={'retries': 2})
+        with mock.patch('requests.post') as post, \
+                mock.patch('threading.Timer') as Timer:
+            post.return_value = FakeResponse(503)
+            SF.comment_on_review('I12345', 3, 'Hello')
+            # retried later, from a timer
+            self.assertEqual(1, post.call_count)
+            Timer.assert_called_once_with(
+                1, SF._post_review, ('I12345', 3, ['Hello'], 1))
+            post.side_effect = [FakeResponse(503), FakeResponse(200)]
+            SF._post_review(*Timer.call_args[0][2])
+            Timer.assert_called_with(
+                2, SF._post_review, ('I12345', 3, ['Hello'], 2))
+            SF._post_review(*Timer.call_args[0][2])
+            self.assertEqual(3, post.call_count)
+            self.assertEqual(2, Timer.call_count)
+            # retries exhausted
+            post.side_effect = None
+            SF._post_review('I12345', 3, ['Hello'], 2)
+            self.assertEqual(2, Timer.call_count)
+
+    def test_retried_errors(self):
+        import requests
+        from urllib3.exceptions import MaxRetryError
+        from urllib3.exceptions import NewConnectionError
+        from urllib3.exceptions import ProtocolError
+        SF = get_SF(reviews={'retries': 2})
+        refused = requests.ConnectionError(MaxRetryError(
+            None, '/review', NewConnectionError(None, 'refused')))
+        aborted = requests.ConnectionError(ProtocolError(
+            'Connection aborted.', Exception('Remote end closed')))
+        with mock.patch('requests.post') as post, \
+                mock.patch('threading.Timer') as Timer:
+            for error in (refused, requests.ConnectTimeout()):
+                post.side_effect = error
+                SF.comment_on_review('I12345', 3, 'Hello')
+            self.assertEqual(2, Timer.call_count)
+            # the review may have been applied, do not post it twice
+            for error in (aborted, requests.ReadTimeout()):
+                post.side_effect = error
+                SF.comment_on_review('I12345', 3, 'Hello')
+            self.assertEqual(2, Timer.call_count)
+
+
+class TestCache(TestCase):
+    def test_get_as(self):
+        SF = get_SF()
+        url = 'http://managesf.sftests.com:20001/project/'
+        with mock.patch('requests.get') as get, \
+                mock.patch('requests.put') as put:
+            get.side_effect = [FakeResponse(200, 'a', {'ETag': '"1"'}),
+                               FakeResponse(304),
+                               FakeResponse(200, 'b', {'ETag': '"2"'})]
+            put.return_value = FakeResponse(201)
+            self.assertEqual('a', SF.get_as('bob', '/project/').text)
+            self.assertEqual('a', SF.get_as('bob', '/project/').text)
+            get.assert_called_with(url, params=None,
+                                   headers={'X-Remote-User': 'bob',
+                                            'If-None-Match': '"1"'})
+            SF.put_as('bob', '/project/p1')
+            self.assertEqual('b', SF.get_as('bob', '/project/').text)
+            get.assert_called_with(url, params=None,
+                                   headers={'X-Remote-User': 'bob'})
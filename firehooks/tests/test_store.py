@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from unittest import TestCase
+
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from firehooks import store
+from firehooks.hooks import trackers
+from firehooks.tests.test_hooks import FakeMessage
+
+
+def patchset_created(patchset, commit_msg='blah TG-1337'):
+    return FakeMessage(
+        topic='gerrit/myproject/patchset-created',
+        payload=json.dumps(
+            {"change": {"commitMessage": commit_msg,
+                        "subject": "a_cool_change",
+                        "owner": {"username": "Johnny"},
+                        "number": 12,
+                        "url": "http://some.url"},
+             "patchSet": {"number": patchset}}))
+
+
+class CountingRegex(object):
+    pattern = 'TG-(\\d+)'
+
+    def __init__(self):
+        self.calls = 0
+
+    def findall(self, msg):
+        self.calls += 1
+        return trackers.TAIGA_REGEX.findall(msg)
+
+
+class TestChangeStore(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_feed(self):
+        s = store.ChangeStore()
+        s.feed(patchset_created(2))
+        s.feed(patchset_created(1))
+        s.feed(FakeMessage('gerrit/myproject/ref-updated', '{}'))
+        state = s.get(12)
+        self.assertEqual(('Johnny', 2), (state.owner, state.patchset))
+        self.assertIsNone(s.get(13))
+
+    def test_refs(self):
+        s = store.ChangeStore()
+        regex = CountingRegex()
+        for i in range(3):
+            self.assertEqual([('1337', '')],
+                             s.refs(12, 'blah TG-1337', regex))
+        self.assertEqual(1, regex.calls)
+        self.assertEqual([('1337', '#closed')],
+                         s.refs(12, 'blah TG-1337 #closed', regex))
+        self.assertEqual(2, regex.calls)
+
+    def test_eviction(self):
+        s = store.ChangeStore(max_changes=2)
+        for number in (1, 2, 3):
+            s.record(number, 'merged')
+        self.assertFalse(s.done(1, 'merged'))
+        self.assertTrue(s.done(3, 'merged'))
+
+    def test_persistence(self):
+        path = os.path.join(self.directory, 'state.db')
+        s = store.ChangeStore(path=path)
+        s.feed(patchset_created(3))
+        s.refs(12, 'blah TG-1337', trackers.TAIGA_REGEX)
+        s.record(12, 'taiga:d:created:1337')
+        s.close()
+        s = store.ChangeStore(path=path)
+        self.assertTrue(s.done(12, 'taiga:d:created:1337'))
+        self.assertEqual(3, s.get(12).patchset)
+        regex = CountingRegex()
+        regex.pattern = trackers.TAIGA_REGEX.pattern
+        self.assertEqual([('1337', '')], s.refs(12, 'blah TG-1337', regex))
+        self.assertEqual(0, regex.calls)
+        s.close()
+
+    def test_deferred_writes(self):
+        path = os.path.join(self.directory, 'state.db')
+        s = store.ChangeStore(path=path, max_changes=2, flush_interval=60)
+        for number in (1, 2, 3):
+            s.record(number, 'merged')
+        count = 'SELECT COUNT(*) FROM changes'
+        # nothing is written until the next flush
+        self.assertEqual(0, s._db.execute(count).fetchone()[0])
+        # evicted from memory, but not lost
+        self.assertTrue(s.done(1, 'merged'))
+        s.flush()
+        # the database is pruned to max_changes too
+        self.assertEqual(2, s._db.execute(count).fetchone()[0])
+        s.close()
+
+
+class TestTaigaHookWithStore(TestCase):
+    def setUp(self):
+        trackers._CLIENTS.clear()
+
+    def test_new_patchset(self):
+        with mock.patch('firehooks.hooks.trackers.TaigaAPI'):
+            T = trackers.TaigaItemUpdateHook(auth={'username': 'a',
+                                                   'password': 'b'},
+                                             project='myproject',
+                                             taiga_project='d')
+            T.store = store.ChangeStore()
+            with mock.patch.object(T, "get_ref_history"):
+                T(patchset_created(1))
+                self.assertEqual(
+                    1, T.project.get_userstory_by_ref.call_count)
+                # nothing relevant changed, no remote call
+                T(patchset_created(2))
+                self.assertEqual(
+                    1, T.project.get_userstory_by_ref.call_count)
+                T(patchset_created(3, 'blah TG-1337 TG-1338'))
+                T.project.get_userstory_by_ref.assert_called_with("1338")
+                self.assertEqual(
+                    2, T.project.get_userstory_by_ref.call_count)